@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Email Triage Agent
+Runs offline against synthetic data; no OpenAI key or server needed
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from email import policy
+from email.parser import BytesParser
+import argparse
+import base64
+import os
+import random
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from near_duplicate import NearDuplicateIndex
+from local_classifier import LocalTriageClassifier, CLASSES
+from mime_ingest import StreamingMessageParser
+from response_parser import parse_triage_response
+
+FIRST_NAMES = ["Alice", "Bob", "Carmen", "Dmitri", "Elena", "Farah", "Goran", "Hiro", "Ines", "Jamal"]
+WORDS = ["project", "invoice", "meeting", "report", "budget", "release", "customer", "schedule",
+         "review", "deadline", "contract", "update", "travel", "expense", "roadmap", "hiring",
+         "launch", "feedback", "quarter", "design", "server", "outage", "policy", "training"]
+
+
+def print_separator(title):
+    """Print a formatted separator."""
+    print(f"\n{'='*60}")
+    print(f" {title}")
+    print(f"{'='*60}")
+
+
+def random_words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def random_token(rng, length=12):
+    return "".join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(length))
+
+
+def make_template(rng):
+    """Build a templated bulk email with slots for a name, a link and a date."""
+    paragraphs = [random_words(rng, 25) for _ in range(4)]
+    return (
+        "Hi {name},\n\n" + paragraphs[0] + "\n\nOrder {order} ships on {date}.\n\n"
+        + paragraphs[1] + "\n\nView online: https://mail.example.com/t/{token}\n\n"
+        + paragraphs[2] + "\n\n" + paragraphs[3] + "\n\nUnsubscribe: https://example.com/u/{token}"
+    )
+
+
+def fill_template(rng, template):
+    return template.format(
+        name=rng.choice(FIRST_NAMES),
+        order=rng.randint(10000, 99999),
+        date=f"2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        token=random_token(rng),
+    )
+
+
+def bench_near_duplicate(args):
+    """Measure near-duplicate reuse accuracy and throughput on a synthetic corpus."""
+    print_separator("Near-duplicate index benchmark")
+    rng = random.Random(args.seed)
+    index = NearDuplicateIndex(max_distance=args.max_distance, bands=args.bands, max_entries=args.max_entries)
+
+    templates = [(f"Your weekly digest #{i}", make_template(rng), rng.choice(["fyi", "discard"]))
+                 for i in range(args.templates)]
+    for subject, template, decision in templates:
+        index.add(index.fingerprint(subject, fill_template(rng, template)), decision)
+
+    queries = []
+    for _ in range(args.queries):
+        if rng.random() < 0.5:
+            subject, template, decision = rng.choice(templates)
+            queries.append((subject, fill_template(rng, template), decision))
+        else:
+            queries.append((f"Re: {random_words(rng, 4)}", random_words(rng, 120), None))
+
+    true_pos = false_pos = false_neg = wrong_decision = 0
+    start = time.perf_counter()
+    for subject, body, expected in queries:
+        found = index.lookup(index.fingerprint(subject, body))
+        if found and expected:
+            true_pos += 1
+            if found != expected:
+                wrong_decision += 1
+        elif found:
+            false_pos += 1
+        elif expected:
+            false_neg += 1
+    elapsed = time.perf_counter() - start
+
+    precision = true_pos / max(true_pos + false_pos, 1)
+    recall = true_pos / max(true_pos + false_neg, 1)
+    print(f"Templates indexed: {args.templates}  Queries: {args.queries}")
+    print(f"Precision: {precision:.3f}  Recall: {recall:.3f}  Wrong decisions: {wrong_decision}")
+    print(f"Throughput: {len(queries) / elapsed:,.0f} lookups/s ({elapsed * 1e6 / len(queries):.1f} us each)")
+    print(f"Index stats: {index.stats()}")
+
+
+CLASS_WORDS = {
+    "fyi": ["newsletter", "announcement", "digest", "notice", "reminder", "summary"],
+    "discard": ["winner", "offer", "discount", "unsubscribe", "prize", "promotion"],
+    "respond": ["please", "could", "question", "available", "confirm", "asap"],
+}
+
+
+def make_labeled_email(rng):
+    """Build a synthetic email whose class shows through a few cue words."""
+    label = rng.choice(CLASSES)
+    words = [rng.choice(WORDS) for _ in range(80)] + [rng.choice(CLASS_WORDS[label]) for _ in range(6)]
+    rng.shuffle(words)
+    author = f"{rng.choice(FIRST_NAMES).lower()}@{rng.choice(['corp.com', 'news.io', 'deals.biz'])}"
+    return author, random_words(rng, 4), " ".join(words), label
+
+
+def bench_local_classifier(args):
+    """Measure local classifier accuracy, coverage and prediction latency."""
+    print_separator("Local classifier benchmark")
+    rng = random.Random(args.seed)
+    classifier = LocalTriageClassifier(threshold=args.threshold, audit_rate=0.0)
+    emails = [make_labeled_email(rng) for _ in range(args.train + args.test)]
+    labeled = [(classifier.features(author, subject, body), label) for author, subject, body, label in emails]
+
+    start = time.perf_counter()
+    classifier.fit(labeled[:args.train])
+    print(f"Trained on {args.train} examples in {time.perf_counter() - start:.2f}s")
+
+    correct = covered = covered_correct = 0
+    start = time.perf_counter()
+    for features, label in labeled[args.train:]:
+        prediction, confidence = classifier.predict(features)
+        correct += prediction == label
+        if classifier.short_circuit(prediction, confidence):
+            covered += 1
+            covered_correct += prediction == label
+    elapsed = time.perf_counter() - start
+
+    print(f"Accuracy: {correct / args.test:.3f}")
+    print(f"Short-circuit coverage: {covered / args.test:.3f} (accuracy {covered_correct / max(covered, 1):.3f})")
+    print(f"Prediction latency: {elapsed * 1e6 / args.test:.1f} us each")
+
+
+def iter_raw_message_with_attachment(attachment_bytes, chunk_size=64 * 1024):
+    """Yield a multipart message with a base64 attachment in chunks, without materializing it."""
+    boundary = "BENCHMARK-BOUNDARY"
+    yield (
+        "From: Sender <sender@example.com>\r\nTo: user@example.com\r\nSubject: Quarterly report\r\n"
+        "Message-ID: <bench@example.com>\r\nMIME-Version: 1.0\r\n"
+        f"Content-Type: multipart/mixed; boundary=\"{boundary}\"\r\n\r\n"
+        f"--{boundary}\r\nContent-Type: multipart/alternative; boundary=\"ALT\"\r\n\r\n"
+        "--ALT\r\nContent-Type: text/plain; charset=utf-8\r\n\r\nPlease review the attached report.\r\n"
+        "--ALT\r\nContent-Type: text/html; charset=utf-8\r\n\r\n<p>Please review the attached report.</p>\r\n"
+        "--ALT--\r\n"
+        f"--{boundary}\r\nContent-Type: application/pdf\r\nContent-Transfer-Encoding: base64\r\n"
+        "Content-Disposition: attachment; filename=\"report.pdf\"\r\n\r\n"
+    ).encode()
+    block = os.urandom(57 * 1024)
+    line_block = b"".join(
+        base64.b64encode(block[i:i + 57]) + b"\r\n" for i in range(0, len(block), 57)
+    )
+    remaining = attachment_bytes
+    pending = b""
+    while remaining > 0:
+        pending += line_block
+        remaining -= len(block)
+        while len(pending) >= chunk_size:
+            yield pending[:chunk_size]
+            pending = pending[chunk_size:]
+    yield pending + f"--{boundary}--\r\n".encode()
+
+
+def measure(func):
+    """Return (result, seconds, peak traced bytes) for one call."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_mime(args):
+    """Measure streaming MIME parse memory and throughput on messages with large attachments."""
+    print_separator("Streaming MIME parser benchmark")
+    for size_mb in args.sizes:
+        size = size_mb * 1024 * 1024
+
+        def streaming():
+            parser = StreamingMessageParser()
+            total = 0
+            for chunk in iter_raw_message_with_attachment(size):
+                total += len(chunk)
+                parser.feed(chunk)
+            return parser.close(), total
+
+        (parsed, total), elapsed, peak = measure(streaming)
+        print(f"{size_mb:>5} MB attachment: {total / elapsed / 1e6:8.1f} MB/s, peak {peak / 1e6:6.2f} MB, "
+              f"body {parsed['email_thread'].strip()!r}, skipped {parsed['skipped_bytes']:,} bytes")
+
+        if args.compare_stdlib:
+            raw = b"".join(iter_raw_message_with_attachment(size))
+            _, elapsed, peak = measure(lambda: BytesParser(policy=policy.default).parsebytes(raw))
+            print(f"{'':>5}    stdlib parser: {len(raw) / elapsed / 1e6:8.1f} MB/s, peak {peak / 1e6:6.2f} MB "
+                  f"(excluding the {len(raw) / 1e6:.1f} MB input buffer)")
+
+
+def legacy_parse(content):
+    """The substring-scan parsing analyze_email used before response_parser, for comparison."""
+    if "Respond" in content.lower() or "professional response:" in content.lower():
+        response_lines, in_response = [], False
+        for line in content.split("\n"):
+            if "response:" in line.lower() or "draft:" in line.lower():
+                in_response = True
+                continue
+            if in_response:
+                response_lines.append(line.strip())
+        return "respond", "\n".join(response_lines)
+    if "fyi" in content.lower() or "no response" in content.lower():
+        return "fyi", None
+    return "discard", None
+
+
+def bench_parser(args):
+    """Compare legacy substring parsing with the regex fallback and structured JSON parsing."""
+    import json
+
+    print_separator("Triage response parser benchmark")
+    rng = random.Random(args.seed)
+    for lines in args.lines:
+        draft = "\n".join("  " + random_words(rng, 12) for _ in range(lines))
+        responses = {
+            "free text respond": f"Respond\nprofessional response:\n{draft}",
+            "free text fyi": f"FYI (no response needed)\n{draft}",
+            "json respond": json.dumps({"category": "respond", "draft": draft, "thread_summary": None}),
+        }
+        print(f"\n{lines} line response (~{len(responses['free text respond']) / 1024:.0f} KB):")
+        for name, content in responses.items():
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                parsed = parse_triage_response(content)
+            elapsed = (time.perf_counter() - start) / args.iterations
+            line = f"  {name:<18} parser {elapsed * 1e6:9.1f} us -> {parsed.category}"
+            if not name.startswith("json"):
+                start = time.perf_counter()
+                for _ in range(args.iterations):
+                    legacy = legacy_parse(content)
+                legacy_elapsed = (time.perf_counter() - start) / args.iterations
+                line += (f"   legacy {legacy_elapsed * 1e6:9.1f} us -> {legacy[0]}"
+                         f"   ({legacy_elapsed / elapsed:4.1f}x)")
+            print(line)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(env, port, timeout=90):
+    """Start main.py in a subprocess and wait until /health answers."""
+    import requests
+
+    server = subprocess.Popen(
+        [sys.executable, "main.py"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, **env, "PORT": str(port)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return server
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("Server did not become healthy")
+
+
+def bench_workers(args):
+    """Measure end-to-end throughput for 1..N uvicorn workers sharing a session database."""
+    import requests
+
+    print_separator("Multi-worker throughput benchmark")
+    rng = random.Random(args.seed)
+    body = "\r\n".join(random_words(rng, 12) for _ in range(args.body_lines))
+    raw_email = (
+        "From: Sender <sender@example.com>\r\nTo: user@example.com\r\nSubject: Status update\r\n\r\n" + body
+    ).encode()
+
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            port = free_port()
+            env = {
+                "WORKERS": str(workers),
+                "SESSION_DB_PATH": os.path.join(tmp, "sessions.db"),
+                "LLM_BACKEND": "stub",
+                "STUB_LLM_LATENCY_SECONDS": str(args.llm_latency),
+                "NEAR_DUPLICATE_ENABLED": "false",
+                "SENDER_HISTORY_ENABLED": "false",
+                "LOCAL_CLASSIFIER_ENABLED": "false",
+            }
+            server = start_server(env, port)
+            base_url = f"http://127.0.0.1:{port}"
+            session = requests.Session()
+
+            def triage_and_approve(_):
+                result = session.post(f"{base_url}/triage_raw_email", data=raw_email,
+                                      headers={"Content-Type": "message/rfc822"}).json()
+                if not result.get("session_id"):
+                    return None
+                approval = session.post(f"{base_url}/triage_email_response",
+                                        json={"session_id": result["session_id"], "approve_email": True})
+                return approval.status_code
+
+            try:
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=args.clients) as pool:
+                    approvals = [code for code in pool.map(triage_and_approve, range(args.requests)) if code]
+                elapsed = time.perf_counter() - start
+            finally:
+                server.terminate()
+                server.wait()
+
+            ok = sum(code == 200 for code in approvals)
+            print(f"{workers} worker(s): {args.requests / elapsed:7.1f} triages/s, "
+                  f"approvals ok {ok}/{len(approvals)} (a 404 would mean a session was lost between workers)")
+
+
+def main():
+    """Run the selected benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    near_dup = subparsers.add_parser("near-duplicate", help="SimHash near-duplicate index")
+    near_dup.add_argument("--templates", type=int, default=500)
+    near_dup.add_argument("--queries", type=int, default=5000)
+    near_dup.add_argument("--max-distance", type=int, default=6)
+    near_dup.add_argument("--bands", type=int, default=8)
+    near_dup.add_argument("--max-entries", type=int, default=10000)
+    near_dup.add_argument("--seed", type=int, default=0)
+    near_dup.set_defaults(func=bench_near_duplicate)
+
+    classifier = subparsers.add_parser("local-classifier", help="Distilled local triage classifier")
+    classifier.add_argument("--train", type=int, default=3000)
+    classifier.add_argument("--test", type=int, default=1000)
+    classifier.add_argument("--threshold", type=float, default=0.9)
+    classifier.add_argument("--seed", type=int, default=0)
+    classifier.set_defaults(func=bench_local_classifier)
+
+    mime = subparsers.add_parser("mime", help="Streaming raw message parser with large attachments")
+    mime.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 50], help="Attachment sizes in MB")
+    mime.add_argument("--compare-stdlib", action="store_true", help="Also parse with email.parser in memory")
+    mime.set_defaults(func=bench_mime)
+
+    response_parser = subparsers.add_parser("parser", help="Triage response parsing on large responses")
+    response_parser.add_argument("--lines", type=int, nargs="+", default=[10, 1000, 10000], help="Draft lines")
+    response_parser.add_argument("--iterations", type=int, default=200)
+    response_parser.add_argument("--seed", type=int, default=0)
+    response_parser.set_defaults(func=bench_parser)
+
+    workers = subparsers.add_parser("workers", help="End-to-end throughput with 1..N uvicorn workers")
+    workers.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    workers.add_argument("--requests", type=int, default=300)
+    workers.add_argument("--clients", type=int, default=16)
+    workers.add_argument("--body-lines", type=int, default=2000, help="Lines of text per email body")
+    workers.add_argument("--llm-latency", type=float, default=0.0, help="Simulated stub LLM latency in seconds")
+    workers.add_argument("--seed", type=int, default=0)
+    workers.set_defaults(func=bench_workers)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
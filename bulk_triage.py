@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Offline bulk triage for mailbox archives
+Streams .mbox files, Maildir/.eml directories or JSONL through EmailTriageAgent
+and writes one JSON result per line, with a checkpoint so interrupted runs resume
+
+    python bulk_triage.py archive.mbox --output results.jsonl --concurrency 8
+"""
+
+from typing import Dict, Any, Optional, Iterator, Tuple, Callable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+from mime_ingest import parse_raw_email
+
+logger = logging.getLogger(__name__)
+
+MBOX_FROM_QUOTED_RE = re.compile(rb"^>+From ")
+
+
+# Every input iterator yields (index, id, item, resume position) where the
+# position is the byte offset just after the item in seekable inputs (mbox,
+# JSONL) and None otherwise. Resuming seeks straight to the checkpointed
+# offset; directories are re-listed but skipped files are never opened.
+
+def _skip(items: Iterator[Tuple[int, str, Any, Optional[int]]], start_index: int):
+    for entry in items:
+        if entry[0] >= start_index:
+            yield entry
+
+
+def iter_mbox(path: str, start_index: int = 0, position: Optional[int] = None) -> Iterator[Tuple[int, str, bytes, int]]:
+    """Yield messages from an mbox file one at a time, starting at a byte offset if given."""
+    with open(path, "rb") as f:
+        number = start_index if position is not None else 0
+        if position is not None:
+            f.seek(position)
+        offset = f.tell()
+        lines = []
+        previous_blank = True
+        for raw_line in f:
+            line = raw_line
+            if line.startswith(b"From ") and previous_blank:
+                if lines:
+                    yield number, f"{path}#{number}", b"".join(lines), offset
+                    number += 1
+                lines = []
+            else:
+                if MBOX_FROM_QUOTED_RE.match(line):
+                    line = line[1:]
+                lines.append(line)
+            previous_blank = line in (b"\n", b"\r\n")
+            offset += len(raw_line)
+        if lines:
+            yield number, f"{path}#{number}", b"".join(lines), offset
+
+
+MAILDIR_MESSAGE_DIRS = ("cur", "new")
+
+
+def iter_message_files(path: str) -> Iterator[Tuple[int, str, Path, None]]:
+    """Yield every message file under a Maildir or .eml directory in a stable order; files are read by the worker.
+
+    In a Maildir only cur/ and new/ hold messages; tmp/ holds partial
+    deliveries and the top level holds index files such as dovecot-uidlist.
+    """
+    maildir = any(os.path.isdir(os.path.join(path, name)) for name in MAILDIR_MESSAGE_DIRS)
+    index = 0
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(name for name in dirs if not (maildir and name == "tmp"))
+        if maildir and os.path.basename(root) not in MAILDIR_MESSAGE_DIRS:
+            continue
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            file_path = os.path.join(root, name)
+            yield index, file_path, Path(file_path), None
+            index += 1
+
+
+def iter_eml(path: str) -> Iterator[Tuple[int, str, Path, None]]:
+    yield 0, path, Path(path), None
+
+
+def iter_jsonl(path: str, start_index: int = 0, position: Optional[int] = None) -> Iterator[Tuple[int, str, Dict[str, Any], int]]:
+    """Yield email fields from a JSONL file with author/to/subject/email_thread keys."""
+    with open(path, "rb") as f:
+        number = start_index if position is not None else 0
+        if position is not None:
+            f.seek(position)
+        offset = f.tell()
+        for line in f:
+            offset += len(line)
+            if line.strip():
+                record = json.loads(line)
+                yield number, str(record.get("id", f"{path}#{number}")), record, offset
+                number += 1
+
+
+def detect_format(path: str) -> str:
+    if os.path.isdir(path):
+        return "maildir"
+    if path.endswith(".jsonl") or path.endswith(".ndjson"):
+        return "jsonl"
+    if path.endswith(".eml"):
+        return "eml"
+    return "mbox"
+
+
+def iter_input(path: str, input_format: str, start_index: int = 0,
+               position: Optional[int] = None) -> Iterator[Tuple[int, str, Any, Optional[int]]]:
+    """Iterate an input from start_index, seeking to position for mbox/JSONL when it is known."""
+    if input_format == "jsonl":
+        items = iter_jsonl(path, start_index, position)
+    elif input_format == "maildir":
+        items = iter_message_files(path)
+    elif input_format == "eml":
+        items = iter_eml(path)
+    else:
+        items = iter_mbox(path, start_index, position)
+    return _skip(items, start_index)
+
+
+EMAIL_FIELDS = ("author", "to", "subject", "email_thread")
+
+
+def to_email_fields(item: Any) -> Dict[str, str]:
+    if isinstance(item, dict):
+        return {key: str(item.get(key, "")) for key in EMAIL_FIELDS}
+    if isinstance(item, Path):
+        item = item.read_bytes()
+    parsed = parse_raw_email(item)
+    return {key: parsed[key] for key in EMAIL_FIELDS}
+
+
+def input_signature(path: str) -> Dict[str, Any]:
+    """Identify an input by path, size and modification time so a checkpoint is only resumed on the same input."""
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        checkpoint = {"offset": 0, "output_bytes": 0, "input_position": 0}
+    # Checkpoints without an input position are resumed by skipping messages
+    checkpoint.setdefault("input_position", None)
+    checkpoint.setdefault("input", None)
+    return checkpoint
+
+
+def save_checkpoint(path: str, offset: int, output_bytes: int, input_position: Optional[int],
+                    signature: Optional[Dict[str, Any]] = None) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"offset": offset, "output_bytes": output_bytes, "input_position": input_position,
+                   "input": signature}, f)
+    os.replace(tmp_path, path)
+
+
+class BulkTriageRunner:
+    """Run archived messages through the agent with bounded concurrency and ordered, resumable output."""
+
+    def __init__(self, agent, concurrency: int = 4, checkpoint_every: int = 100):
+        self.agent = agent
+        self.concurrency = concurrency
+        self.checkpoint_every = checkpoint_every
+
+    def triage_one(self, index: int, message_id: str, item: Any) -> Dict[str, Any]:
+        try:
+            fields = to_email_fields(item)
+        except Exception as e:
+            return {"index": index, "id": message_id, "triage_decision": "error",
+                    "message": f"Error parsing message: {str(e)}"}
+        session_id = f"bulk-{index}"
+        result = self.agent.process_email(session_id=session_id, **fields)
+        # Offline runs never resume a session, so free its checkpoint right away
+        self.agent.discard_session(session_id)
+        return {
+            "index": index,
+            "id": message_id,
+            "author": fields["author"],
+            "subject": fields["subject"],
+            **result,
+        }
+
+    def run(self, open_input: Callable[[int, Optional[int]], Iterator[Tuple[int, str, Any, Optional[int]]]],
+            output_path: str, checkpoint_path: str, limit: Optional[int] = None,
+            signature: Optional[Dict[str, Any]] = None) -> int:
+        """Triage every item after the checkpointed offset; returns the number processed in this run.
+
+        open_input(start_index, input_position) returns the input iterator,
+        positioned at the first message that still needs triage. A checkpoint
+        written for a different input signature is refused with ValueError.
+        """
+        checkpoint = load_checkpoint(checkpoint_path)
+        start = checkpoint["offset"]
+        input_position = checkpoint["input_position"]
+        if start and signature and checkpoint["input"] != signature:
+            raise ValueError(
+                f"Checkpoint {checkpoint_path} was written for a different or modified input "
+                f"({checkpoint['input']}); remove it or choose another --output to start over"
+            )
+        if start:
+            logger.info(f"Resuming after {start} messages (input position {input_position})")
+
+        processed = 0
+        mode = "r+" if start and os.path.exists(output_path) else "w"
+        with open(output_path, mode) as output, ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            # Drop results written after the last checkpoint so none are duplicated
+            output.seek(checkpoint["output_bytes"] if mode == "r+" else 0)
+            output.truncate()
+            in_flight = deque()
+
+            def write_oldest():
+                nonlocal processed, input_position
+                future, input_position = in_flight.popleft()
+                output.write(json.dumps(future.result()) + "\n")
+                processed += 1
+                if processed % self.checkpoint_every == 0:
+                    output.flush()
+                    save_checkpoint(checkpoint_path, start + processed, output.tell(), input_position, signature)
+
+            for index, message_id, item, position in open_input(start, input_position):
+                if limit is not None and index >= start + limit:
+                    break
+                in_flight.append((pool.submit(self.triage_one, index, message_id, item), position))
+                # Bound the number of parsed messages held in memory
+                if len(in_flight) >= self.concurrency * 2:
+                    write_oldest()
+            while in_flight:
+                write_oldest()
+            output.flush()
+            save_checkpoint(checkpoint_path, start + processed, output.tell(), input_position, signature)
+        return processed
+
+
+def main():
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="Path to an .mbox file, Maildir/.eml directory, .eml file or JSONL file")
+    parser.add_argument("--format", choices=["auto", "mbox", "maildir", "eml", "jsonl"], default="auto")
+    parser.add_argument("--output", default="triage_results.jsonl")
+    parser.add_argument("--checkpoint", help="Checkpoint path (default: <output>.checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--checkpoint-every", type=int, default=100)
+    parser.add_argument("--limit", type=int, help="Stop after this many messages in this run")
+    args = parser.parse_args()
+
+    from email_agent_correct import EmailTriageAgent
+
+    input_format = detect_format(args.input) if args.format == "auto" else args.format
+    runner = BulkTriageRunner(EmailTriageAgent(), concurrency=args.concurrency, checkpoint_every=args.checkpoint_every)
+    try:
+        processed = runner.run(
+            lambda start, position: iter_input(args.input, input_format, start, position),
+            args.output,
+            args.checkpoint or f"{args.output}.checkpoint",
+            limit=args.limit,
+            signature=input_signature(args.input),
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Triaged {processed} messages into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
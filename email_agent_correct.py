@@ -5,10 +5,24 @@ from langgraph.prebuilt import ToolNode
 from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
 from langchain_openai import ChatOpenAI
 from langchain_core.tools import tool
+from collections import OrderedDict
 import json
 import os
 import logging
 import pprint
+import threading
+from near_duplicate import NearDuplicateIndex
+from sender_history import SenderHistoryIndex
+from local_classifier import LocalTriageClassifier
+from usage_accounting import UsageLedger, model_name, recipient_tenant
+from prompts import PromptLibrary
+from response_parser import bind_triage_schema, parse_triage_response
+from thread_context import (
+    THREAD_CONTEXT_PREFIX,
+    text_hash,
+    new_message_delta,
+    rolling_summary,
+)
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,18 +39,70 @@ class EmailState(TypedDict):
     needs_human_input: bool
     messages: List[BaseMessage]
     human_approval: Optional[bool]
+    triage_source: Optional[str]
+    thread_key: Optional[str]
+    thread_summary: Optional[str]
+    prior_decision: Optional[str]
+    new_message: Optional[str]
+    thread_context: Dict[str, Any]
+    tenant: Optional[str]
+    token_usage: Optional[Dict[str, Any]]
+
+# Canned answers used when LLM_BACKEND=stub (benchmarks and soak tests)
+STUB_LLM_RESPONSES = [
+    "1. FYI (no response needed)",
+    "Respond\nprofessional response:\nThank you for your email. I will get back to you shortly.",
+    "2. Discard (spam/unimportant)",
+]
+
+def create_llm(model: str = "gpt-4"):
+    """Create the chat model; LLM_BACKEND=stub returns canned answers without calling OpenAI."""
+    if os.getenv("LLM_BACKEND", "openai") == "stub":
+        from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+        return FakeListChatModel(
+            responses=STUB_LLM_RESPONSES,
+            sleep=float(os.getenv("STUB_LLM_LATENCY_SECONDS", "0"))
+        )
+    return ChatOpenAI(
+        model=model,
+        temperature=0,
+        api_key=os.getenv("OPENAI_API_KEY")
+    )
 
 class EmailTriageAgent:
-    def __init__(self):
+    def __init__(self, checkpointer=None):
         """Initialize the email triage agent with LangGraph."""
-        self.llm = ChatOpenAI(
-            model="gpt-4",
-            temperature=0,
-            api_key=os.getenv("OPENAI_API_KEY")
-        )
+        self.llm = create_llm()
+        
+        # Cheaper model used once a token or regeneration budget is exhausted
+        self.cheap_llm = create_llm(os.getenv("CHEAP_LLM_MODEL", "gpt-4o-mini"))
+        self.usage = UsageLedger.from_env()
+        
+        # Prompt templates are compiled once; their static prefixes are shared by every call
+        self.prompts = PromptLibrary.from_env()
         
-        # Initialize the memory saver for state persistence
-        self.memory_saver = MemorySaver()
+        # Ask for a TriageOutput function call/JSON payload instead of free text
+        self.structured_output = os.getenv("TRIAGE_STRUCTURED_OUTPUT", "false").lower() == "true"
+        self._structured_llms: Dict[int, Any] = {}
+        
+        # Initialize the memory saver for state persistence; a shared
+        # checkpointer can be passed in so several workers see the same sessions
+        self.memory_saver = checkpointer if checkpointer is not None else MemorySaver()
+
+        # Reuse decisions for templated bulk mail that was already triaged
+        self.near_duplicates = NearDuplicateIndex.from_env()
+
+        # Answer senders with a consistent verdict without calling the LLM
+        self.sender_history = SenderHistoryIndex.from_env()
+
+        # Local classifier distilled from LLM decisions, gated on confidence
+        self.local_classifier = LocalTriageClassifier.from_env()
+
+        # Thread contexts are LRU-capped so one-off Message-IDs do not accumulate
+        self.thread_context_max_entries = int(os.getenv("THREAD_CONTEXT_MAX_ENTRIES", "10000"))
+        self._thread_keys: "OrderedDict[str, None]" = OrderedDict()
+        self._thread_keys_lock = threading.Lock()
         
         # Build the LangGraph
         self.graph = self._build_graph()
@@ -49,41 +115,72 @@ class EmailTriageAgent:
         # Define the nodes
         def analyze_email(state: EmailState) -> EmailState:
             """Analyze the email content and make initial triage decision."""
-            prompt = f"""
-            Analyze the following email and determine the appropriate action:
-            
-            Author: {state['author']}
-            To: {state['to']}
-            Subject: {state['subject']}
-            Email Thread: {state['email_thread']}
-            
-            Determine if this email should be classified in one of the following categories:
-            1. FYI (no response needed)
-            2. Discard (spam/unimportant)
-            3. Respond (requires action)
-            
-            If a response is needed, insert a line that says "professional response:" and then draft a professional response starting on the next line.
-            """
+            history_decision = self.sender_history.lookup(state['author'])
+            if history_decision:
+                logger.info(f"Using sender history triage decision: {history_decision}")
+                state['triage_decision'] = history_decision
+                state['needs_human_input'] = False
+                state['triage_source'] = "sender_history"
+                self._fold_thread_summary(state)
+                return state
+
+            fingerprint, reused_decision = None, None
+            if self.near_duplicates.enabled:
+                fingerprint = self.near_duplicates.fingerprint(state['subject'], state['email_thread'])
+                reused_decision = self.near_duplicates.lookup(fingerprint)
+            if reused_decision:
+                logger.info(f"Reusing near-duplicate triage decision: {reused_decision}")
+                state['triage_decision'] = reused_decision
+                state['needs_human_input'] = False
+                state['triage_source'] = "near_duplicate"
+                self._fold_thread_summary(state)
+                return state
+
+            features, prediction, confidence = [], None, 0.0
+            if self.local_classifier.enabled:
+                features = self.local_classifier.features(state['author'], state['subject'], state['email_thread'])
+                prediction, confidence = self.local_classifier.predict(features)
+                if self.local_classifier.short_circuit(prediction, confidence):
+                    logger.info(f"Using local classifier triage decision: {prediction} ({confidence:.3f})")
+                    state['triage_decision'] = prediction
+                    state['needs_human_input'] = False
+                    state['triage_source'] = "local_classifier"
+                    self._fold_thread_summary(state)
+                    return state
+
+            # Follow-ups in a known thread send the summary and only the new message
+            prompt = self.prompts.triage(state, self.structured_output)
             logger.info("Analyzing email content")
-            response = self.llm.invoke([HumanMessage(content=prompt)])
+            llm = self.llm
+            degraded = not self.usage.allow_full_model(state.get('tenant'))
+            if degraded:
+                logger.info(f"Token budget exhausted for tenant {state.get('tenant')}; using cheaper model")
+                llm = self.cheap_llm
+            response = self._triage_llm(llm).invoke(prompt)
+            state['token_usage'] = self.usage.record(
+                state.get('token_usage'), "analyze_email", model_name(llm), response,
+                state['author'], state.get('tenant'), degraded
+            )
+            state['triage_source'] = "llm"
             state['messages'].append(AIMessage(content=response.content))
             logger.info(f"Full LLM response: {response}")
             logger.info(f"LLM content received: {response.content}...")
-            
+
             # Parse the response to determine action
-            if "Respond" in response.content.lower() or "professional response:" in response.content.lower():
-                logger.info("IN THE RESPONSE BLOCK")
-                state['triage_decision'] = "respond"
-                state['needs_human_input'] = True
-                # Extract or generate draft response
-                state['drafted_response'] = self._extract_draft_response(response.content)
+            parsed = parse_triage_response(response, with_summary=bool(state.get('thread_key')))
+            self._fold_thread_summary(state, parsed.thread_summary)
+            
+            state['triage_decision'] = parsed.category
+            state['needs_human_input'] = parsed.category == "respond"
+            if parsed.category == "respond":
+                state['drafted_response'] = parsed.draft
                 self._save_draft_to_state(state['session_id'], state['drafted_response'])
-            elif "fyi" in response.content.lower() or "no response" in response.content.lower():
-                state['triage_decision'] = "fyi"
-                state['needs_human_input'] = False
-            else:
-                state['triage_decision'] = "discard"
-                state['needs_human_input'] = False
+
+            # Only LLM verdicts feed the history; shortcut answers are guesses and would reinforce themselves.
+            # "respond" is counted here because the graph is interrupted before finalize_decision runs.
+            self.sender_history.record(state['author'], state['triage_decision'])
+            self.near_duplicates.add(fingerprint, state['triage_decision'])
+            self.local_classifier.observe(features, prediction, confidence, state['triage_decision'])
             
             return state
         
@@ -113,7 +210,7 @@ class EmailTriageAgent:
                 state['triage_decision'] = "sent"
             elif state.get('human_approval') is False:
                 # Reject the response, generate new draft
-                new_draft = self._generate_new_draft(state['session_id'])
+                new_draft = self._generate_new_draft(state['session_id'], state)
                 state['drafted_response'] = new_draft
                 state['messages'].append(AIMessage(content="New email draft generated."))
                 # Continue to need human input
@@ -157,35 +254,31 @@ class EmailTriageAgent:
         
         return workflow.compile(checkpointer=self.memory_saver)
     
-    def _extract_draft_response(self, llm_response: str) -> str:
-        """Extract the drafted email response from the LLM response."""
-        # Simple extraction - look for response content
-        lines = llm_response.split('\n')
-        response_lines = []
-        in_response = False
-        
-        for line in lines:
-            logger.info(f"Processing line: {line}")
-            if "response:" in line.lower() or "draft:" in line.lower():
-                logger.info("FOUND RESPONSE HEADER")
-                in_response = True
-                continue
-
-            if in_response:
-                response_lines.append(line.strip())
-                
-        
-        if response_lines:
-            response_final = '\n'.join(response_lines)
-            logger.info(f"Final response: {response_final}")
-            return response_final
-        else:
-            # Fallback: return a generic response
-            return "Thank you for your email. I will review this and get back to you shortly."
+    def _triage_llm(self, llm):
+        """The model used for triage; bound to the TriageOutput schema in structured mode."""
+        if not self.structured_output:
+            return llm
+        if id(llm) not in self._structured_llms:
+            self._structured_llms[id(llm)] = bind_triage_schema(llm)
+        return self._structured_llms[id(llm)]
+    
+    def _fold_thread_summary(self, state: EmailState, summary: Optional[str] = None) -> None:
+        """Update the thread summary with the LLM's, else fold the new message into the rolling one."""
+        if state.get('thread_key'):
+            state['thread_summary'] = summary or rolling_summary(
+                state.get('thread_summary'), state.get('new_message') or state['email_thread']
+            )
     
-    def process_email(self, author: str, to: str, subject: str, email_thread: str, session_id: str) -> Dict[str, Any]:
+    def process_email(self, author: str, to: str, subject: str, email_thread: str, session_id: str,
+                      thread_key: Optional[str] = None, tenant: Optional[str] = None) -> Dict[str, Any]:
         """Process an email through the triage agent."""
         try:
+            # Follow-ups in a known thread are triaged against its summary and the new message only
+            context = self._load_thread_context(thread_key) if thread_key else {}
+            new_message = None
+            if context.get('thread_summary'):
+                new_message = new_message_delta(email_thread, context.get('seen_length', 0), context.get('seen_hash'))
+
             # Create initial state
             initial_state = EmailState(
                 author=author,
@@ -197,27 +290,40 @@ class EmailTriageAgent:
                 drafted_response=None,
                 needs_human_input=False,
                 messages=[],
-                human_approval=None
+                human_approval=None,
+                triage_source=None,
+                thread_key=thread_key,
+                thread_summary=context.get('thread_summary'),
+                prior_decision=context.get('prior_decision'),
+                new_message=new_message,
+                tenant=tenant or recipient_tenant(to),
+                token_usage=None
             )
             
             # Run the graph
             result = self.graph.invoke(initial_state, config={"configurable": {"thread_id": session_id}})
             logger.info(f"Graph execution completed: {result.get('triage_decision', 'unknown')}")
+            if thread_key:
+                self._save_thread_context(thread_key, session_id)
             
             return {
                 "triage_decision": result.get("triage_decision"),
                 "needs_response": result.get("triage_decision") == "respond",
                 "drafted_response": result.get("drafted_response"),
+                "token_usage": result.get("token_usage"),
                 "message": "Email processed successfully"
             }
             
         except InterruptedError:
             # Graph was interrupted, need human input
             # The state is already saved by the memory saver
+            if thread_key:
+                self._save_thread_context(thread_key, session_id)
             return {
                 "triage_decision": "respond",
                 "needs_response": True,
                 "drafted_response": self._get_draft_from_state(session_id),
+                "token_usage": self.get_session_usage(session_id),
                 "message": "Email requires human approval for response"
             }
         except Exception as e:
@@ -227,6 +333,68 @@ class EmailTriageAgent:
                 "message": f"Error processing email: {str(e)}"
             }
     
+    def _load_thread_context(self, thread_key: str) -> Dict[str, Any]:
+        """Return the rolling summary and prior decision stored for a thread."""
+        state = self.memory_saver.get({"configurable": {"thread_id": THREAD_CONTEXT_PREFIX + thread_key}})
+        if state and 'channel_values' in state:
+            return state['channel_values'].get('thread_context', {})
+        return {}
+    
+    def _save_thread_context(self, thread_key: str, session_id: str) -> None:
+        """Store the thread's updated summary and decision from a finished session."""
+        try:
+            state = self.memory_saver.get({"configurable": {"thread_id": session_id}})
+            values = state['channel_values']
+            email_thread = values['email_thread']
+            summary = values.get('thread_summary') or rolling_summary(None, values.get('new_message') or email_thread)
+            context = {
+                "thread_summary": summary,
+                "prior_decision": values.get('triage_decision'),
+                "seen_length": len(email_thread),
+                "seen_hash": text_hash(email_thread),
+            }
+            # Keep only the latest context checkpoint for the thread
+            config = {"configurable": {"thread_id": THREAD_CONTEXT_PREFIX + thread_key}}
+            self.memory_saver.delete_thread(THREAD_CONTEXT_PREFIX + thread_key)
+            self.graph.update_state(config, {"thread_context": context}, as_node="finalize_decision")
+            self._touch_thread_context(thread_key)
+        except Exception as e:
+            logger.warning(f"Could not save thread context for {thread_key}: {e}")
+    
+    def _touch_thread_context(self, thread_key: str) -> None:
+        """Mark a thread context as recently used and delete the least recently used ones over the cap."""
+        with self._thread_keys_lock:
+            self._thread_keys[thread_key] = None
+            self._thread_keys.move_to_end(thread_key)
+            evicted = []
+            while len(self._thread_keys) > self.thread_context_max_entries:
+                evicted.append(self._thread_keys.popitem(last=False)[0])
+        for key in evicted:
+            self.memory_saver.delete_thread(THREAD_CONTEXT_PREFIX + key)
+    
+    def get_session_usage(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Return the cumulative token usage recorded for a session."""
+        state = self.memory_saver.get({"configurable": {"thread_id": session_id}})
+        if state and 'channel_values' in state:
+            return state['channel_values'].get('token_usage')
+        return None
+    
+    def export_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Return a session's saved values without the message log, for snapshots."""
+        state = self.memory_saver.get({"configurable": {"thread_id": session_id}})
+        if state and 'channel_values' in state:
+            return {key: value for key, value in state['channel_values'].items() if key != 'messages'}
+        return None
+    
+    def import_session(self, session_id: str, values: Dict[str, Any]) -> None:
+        """Recreate a session's saved state so approval and rejection can resume it."""
+        values = {**values, 'messages': []}
+        self.graph.update_state({"configurable": {"thread_id": session_id}}, values, as_node="analyze_email")
+    
+    def discard_session(self, session_id: str) -> None:
+        """Drop all saved state for a session that will not be resumed."""
+        self.memory_saver.delete_thread(session_id)
+    
     def _save_draft_to_state(self, session_id: str, draft: str) -> Optional[str]:
         """Retrieve the draft response from the saved state."""
         logger.info(f"Saving draft to state for session ID: {session_id}")
@@ -259,6 +427,15 @@ class EmailTriageAgent:
             pass
         return None
     
+    def _record_human_signal(self, session_id: str) -> None:
+        """Count a human-confirmed response against the session's sender, on top of the LLM verdict."""
+        try:
+            state = self.memory_saver.get({"configurable": {"thread_id": session_id}})
+            if state and 'author' in state.get('channel_values', {}):
+                self.sender_history.record(state['channel_values']['author'], "respond")
+        except Exception as e:
+            logger.warning(f"Could not record sender history for session {session_id}: {e}")
+    
     def approve_response(self, session_id: str) -> Dict[str, Any]:
         """Approve and send the email response."""
         try:
@@ -273,6 +450,7 @@ class EmailTriageAgent:
             
             # Logic to actually send the email
             logger.info(f"Sending faux email response for session ID: {session_id}")
+            self._record_human_signal(session_id)
 
             return
             
@@ -314,8 +492,8 @@ class EmailTriageAgent:
                 "message": f"Error generating new draft: {str(e)}"
             }
     
-    def _generate_new_draft(self, session_id: str) -> str:
-        """Generate a new email draft."""
+    def _generate_new_draft(self, session_id: str, node_state: Optional[EmailState] = None) -> str:
+        """Generate a new email draft, recording token usage on node_state when given."""
         logger.info(f"Generating new email draft for session ID: {session_id}")
         try:
             # Get the original email context from the saved state
@@ -326,17 +504,22 @@ class EmailTriageAgent:
                 values = state['channel_values']
                 logger.info(f"Values:")
                 pprint.pprint(values, indent=4)
-                prompt = f"""
-                Generate a new email response for:
-                
-                Author: {values.get('author', 'Unknown')}
-                Subject: {values.get('subject', 'Unknown')}
-                Email Thread: {values.get('email_thread', 'Unknown')}
-                
-                Make sure it is professional and appropriate.
-                """
+                prompt = self.prompts.draft(values)
                 
-                response = self.llm.invoke([HumanMessage(content=prompt)])
+                usage = values.get('token_usage')
+                llm = self.llm
+                degraded = not self.usage.allow_full_model(values.get('tenant'), usage, regeneration=True)
+                if degraded:
+                    logger.info(f"Regeneration budget exhausted for session {session_id}; using cheaper model")
+                    llm = self.cheap_llm
+                response = llm.invoke(prompt)
+                usage = self.usage.record(
+                    usage, "regenerate_draft", model_name(llm), response,
+                    values.get('author', ''), values.get('tenant'), degraded
+                )
+                usage['regenerations'] += 1
+                if node_state is not None:
+                    node_state['token_usage'] = usage
                 logger.info(f"New email draft generated: {response.content}")
                 self._save_draft_to_state(session_id, response.content)
                 return response.content
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Local triage classifier distilled from LLM decisions
+Hashed n-gram features with multinomial logistic regression, pure Python on CPU
+
+Train from the logged examples (and the rotated <path>.1, if present) with:
+    python local_classifier.py train --examples triage_examples.jsonl --model triage_classifier.json
+"""
+
+from typing import Dict, Any, Optional, List, Tuple
+import argparse
+import atexit
+import json
+import logging
+import math
+import os
+import queue
+import random
+import threading
+import zlib
+
+from near_duplicate import normalize_email_text
+from response_parser import SHORT_CIRCUIT_DECISIONS
+from sender_history import sender_address, sender_domain
+
+logger = logging.getLogger(__name__)
+
+CLASSES = ("fyi", "discard", "respond")
+MAX_TOKENS = 400
+
+
+def extract_features(author: str, subject: str, email_thread: str, n_features: int) -> List[int]:
+    """Hash unigrams, bigrams and the sender domain into sorted feature indices."""
+    tokens = normalize_email_text(subject, email_thread)[:MAX_TOKENS]
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    grams.append(f"__domain__ {sender_domain(sender_address(author))}")
+    return sorted({zlib.crc32(gram.encode("utf-8")) % n_features for gram in grams})
+
+
+class LocalTriageClassifier:
+    """Confidence-gated first triage stage that falls back to the LLM when unsure."""
+
+    def __init__(self, model_path: Optional[str] = None, examples_path: Optional[str] = None,
+                 threshold: float = 0.9, audit_rate: float = 0.05, n_features: int = 1 << 18,
+                 enabled: bool = True, examples_max_bytes: int = 50 * 1024 * 1024):
+        self.model_path = model_path
+        self.examples_path = examples_path
+        self.examples_max_bytes = examples_max_bytes
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.n_features = n_features
+        self.enabled = enabled
+        self.weights: List[Dict[int, float]] = [{} for _ in CLASSES]
+        self.bias = [0.0] * len(CLASSES)
+        self.trained = False
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        # Example lines are appended by a background writer so triage threads never wait on disk
+        self._examples: "queue.SimpleQueue[Optional[str]]" = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        self.metrics = {
+            "predictions": 0,
+            "short_circuits": 0,
+            "audits": 0,
+            "compared": 0,
+            "agreed": 0,
+            "confident_compared": 0,
+            "confident_agreed": 0,
+        }
+        if model_path and os.path.exists(model_path):
+            self.load(model_path)
+
+    @classmethod
+    def from_env(cls) -> "LocalTriageClassifier":
+        """Create a classifier configured from LOCAL_CLASSIFIER_* environment variables."""
+        return cls(
+            model_path=os.getenv("LOCAL_CLASSIFIER_MODEL_PATH", "triage_classifier.json") or None,
+            # Example logging is opt-in: on Cloud Run the writable filesystem lives in memory
+            examples_path=os.getenv("LOCAL_CLASSIFIER_EXAMPLES_PATH") or None,
+            examples_max_bytes=int(os.getenv("LOCAL_CLASSIFIER_EXAMPLES_MAX_BYTES", str(50 * 1024 * 1024))),
+            threshold=float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", "0.9")),
+            audit_rate=float(os.getenv("LOCAL_CLASSIFIER_AUDIT_RATE", "0.05")),
+            enabled=os.getenv("LOCAL_CLASSIFIER_ENABLED", "true").lower() == "true",
+        )
+
+    def features(self, author: str, subject: str, email_thread: str) -> List[int]:
+        return extract_features(author, subject, email_thread, self.n_features)
+
+    def predict_proba(self, features: List[int]) -> List[float]:
+        value = 1.0 / math.sqrt(len(features)) if features else 0.0
+        scores = [
+            self.bias[c] + value * sum(weights.get(i, 0.0) for i in features)
+            for c, weights in enumerate(self.weights)
+        ]
+        top = max(scores)
+        exps = [math.exp(s - top) for s in scores]
+        total = sum(exps)
+        return [e / total for e in exps]
+
+    def predict(self, features: List[int]) -> Tuple[Optional[str], float]:
+        """Return the predicted class and its probability, or (None, 0.0) without a model."""
+        if not self.enabled or not self.trained:
+            return None, 0.0
+        probs = self.predict_proba(features)
+        best = max(range(len(CLASSES)), key=lambda c: probs[c])
+        with self._lock:
+            self.metrics["predictions"] += 1
+        return CLASSES[best], probs[best]
+
+    def short_circuit(self, prediction: Optional[str], confidence: float) -> bool:
+        """Decide whether a prediction answers triage without the LLM; a sample is audited instead."""
+        if prediction not in SHORT_CIRCUIT_DECISIONS or confidence < self.threshold:
+            return False
+        with self._lock:
+            if self._random.random() < self.audit_rate:
+                self.metrics["audits"] += 1
+                return False
+            self.metrics["short_circuits"] += 1
+        return True
+
+    def observe(self, features: List[int], prediction: Optional[str], confidence: float, decision: str) -> None:
+        """Log an LLM-labeled example and update agreement metrics."""
+        if not self.enabled or decision not in CLASSES:
+            return
+        with self._lock:
+            if prediction is not None:
+                self.metrics["compared"] += 1
+                self.metrics["agreed"] += prediction == decision
+                if confidence >= self.threshold:
+                    self.metrics["confident_compared"] += 1
+                    self.metrics["confident_agreed"] += prediction == decision
+            if self.examples_path and self._writer is None:
+                self._writer = threading.Thread(target=self._write_examples, daemon=True)
+                self._writer.start()
+                atexit.register(self.close)
+        if self.examples_path:
+            self._examples.put(json.dumps({"features": features, "decision": decision}, separators=(",", ":")) + "\n")
+
+    def _write_examples(self) -> None:
+        """Append queued example lines, rotating the log to <path>.1 at the size cap."""
+        stopping = False
+        while not stopping:
+            lines = [self._examples.get()]
+            while lines[-1] is not None:
+                try:
+                    lines.append(self._examples.get_nowait())
+                except queue.Empty:
+                    break
+            if lines[-1] is None:
+                stopping = True
+                lines.pop()
+            if not lines:
+                continue
+            try:
+                with open(self.examples_path, "a") as f:
+                    f.write("".join(lines))
+                    size = f.tell()
+                if self.examples_max_bytes and size >= self.examples_max_bytes:
+                    # Keep one rotated generation; train reads it along with the current log
+                    os.replace(self.examples_path, f"{self.examples_path}.1")
+            except OSError as e:
+                logger.warning(f"Could not log {len(lines)} triage examples to {self.examples_path}: {e}")
+
+    def close(self) -> None:
+        """Write the queued examples and stop the writer."""
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._examples.put(None)
+            writer.join(timeout=10)
+
+    def fit(self, examples: List[Tuple[List[int], str]], epochs: int = 5, learning_rate: float = 0.5,
+            l2: float = 1e-6, seed: int = 0) -> None:
+        """Train with SGD on (features, decision) pairs; L2 is applied lazily to touched weights."""
+        rng = random.Random(seed)
+        examples = [(x, CLASSES.index(y)) for x, y in examples if y in CLASSES and x]
+        weights: List[Dict[int, float]] = [{} for _ in CLASSES]
+        bias = [0.0] * len(CLASSES)
+        self.weights, self.bias = weights, bias
+        for epoch in range(epochs):
+            rng.shuffle(examples)
+            rate = learning_rate / (1 + epoch)
+            for features, label in examples:
+                value = 1.0 / math.sqrt(len(features))
+                probs = self.predict_proba(features)
+                for c, weights_c in enumerate(weights):
+                    gradient = probs[c] - (c == label)
+                    bias[c] -= rate * gradient
+                    step = rate * gradient * value
+                    for i in features:
+                        w = weights_c.get(i, 0.0)
+                        weights_c[i] = w - step - rate * l2 * w
+        self.trained = bool(examples)
+
+    def save(self, path: str) -> None:
+        payload = {
+            "classes": CLASSES,
+            "n_features": self.n_features,
+            "bias": self.bias,
+            "weights": [{str(i): round(w, 6) for i, w in weights.items() if abs(w) > 1e-6} for weights in self.weights],
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(payload, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path) as f:
+                payload = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load local classifier from {path}: {e}")
+            return
+        if tuple(payload.get("classes", ())) != CLASSES:
+            logger.warning(f"Ignoring local classifier with unknown classes: {path}")
+            return
+        self.n_features = payload["n_features"]
+        self.bias = payload["bias"]
+        self.weights = [{int(i): w for i, w in weights.items()} for weights in payload["weights"]]
+        self.trained = True
+        logger.info(f"Loaded local triage classifier from {path}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = dict(self.metrics)
+        metrics["agreement_rate"] = metrics["agreed"] / metrics["compared"] if metrics["compared"] else None
+        metrics["confident_agreement_rate"] = (
+            metrics["confident_agreed"] / metrics["confident_compared"] if metrics["confident_compared"] else None
+        )
+        return {"enabled": self.enabled, "trained": self.trained, "threshold": self.threshold, **metrics}
+
+
+def load_examples(*paths: str) -> List[Tuple[List[int], str]]:
+    examples = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    examples.append((record["features"], record["decision"]))
+    return examples
+
+
+def example_paths(paths: Optional[List[str]]) -> List[str]:
+    """Return the given example logs, or the configured log preceded by its rotated generation."""
+    if paths:
+        return paths
+    path = os.getenv("LOCAL_CLASSIFIER_EXAMPLES_PATH") or "triage_examples.jsonl"
+    return [p for p in (f"{path}.1", path) if os.path.exists(p)] or [path]
+
+
+def train(args):
+    """Train a classifier from logged examples and report holdout accuracy and coverage."""
+    paths = example_paths(args.examples)
+    examples = load_examples(*paths)
+    print(f"Loaded {len(examples)} examples from {', '.join(paths)}")
+    random.Random(args.seed).shuffle(examples)
+    holdout_size = int(len(examples) * args.holdout)
+    holdout, training = examples[:holdout_size], examples[holdout_size:]
+    print(f"Training on {len(training)} examples, holding out {len(holdout)}")
+
+    classifier = LocalTriageClassifier(threshold=args.threshold)
+    classifier.fit(training, epochs=args.epochs, learning_rate=args.learning_rate, seed=args.seed)
+
+    if holdout:
+        correct = confident = confident_correct = 0
+        for features, decision in holdout:
+            prediction, confidence = classifier.predict(features)
+            correct += prediction == decision
+            if prediction in SHORT_CIRCUIT_DECISIONS and confidence >= args.threshold:
+                confident += 1
+                confident_correct += prediction == decision
+        print(f"Holdout accuracy: {correct / len(holdout):.3f}")
+        print(f"Coverage at threshold {args.threshold}: {confident / len(holdout):.3f} "
+              f"(accuracy {confident_correct / max(confident, 1):.3f})")
+
+    classifier.save(args.model)
+    print(f"Saved model to {args.model}")
+
+
+def main():
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train", help="Train from logged (features, decision) examples")
+    train_parser.add_argument("--examples", nargs="+",
+                              help="Example logs (default: LOCAL_CLASSIFIER_EXAMPLES_PATH and its rotated .1 file)")
+    train_parser.add_argument("--model", default=os.getenv("LOCAL_CLASSIFIER_MODEL_PATH", "triage_classifier.json"))
+    train_parser.add_argument("--threshold", type=float, default=float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", "0.9")))
+    train_parser.add_argument("--holdout", type=float, default=0.2)
+    train_parser.add_argument("--epochs", type=int, default=5)
+    train_parser.add_argument("--learning-rate", type=float, default=0.5)
+    train_parser.add_argument("--seed", type=int, default=0)
+    train_parser.set_defaults(func=train)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,108 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response, UploadFile, File
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, MutableMapping
+from contextlib import asynccontextmanager
+import asyncio
+import os
+import time
 import uuid
 import logging
 import pprint
 from email_agent_correct import EmailTriageAgent
+from mime_ingest import HeaderLimitExceeded, StreamingMessageParser
+from thread_context import derive_thread_key
+from push_ingest import MicroBatcher, decode_push_envelope
+from session_store import create_checkpointer, create_session_store
+from session_snapshot import SessionSnapshot
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Email Triage Agent", version="1.0.0")
+# Overall seconds from SIGTERM to exit; Cloud Run kills the instance 10 s after SIGTERM.
+# In-flight requests (including push requests waiting for their batch) get the first
+# share, the rest covers the snapshot and whatever the push batcher still runs.
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", 8))
+REQUEST_DRAIN_SECONDS = SHUTDOWN_DRAIN_SECONDS * 0.6
 
-# Initialize the email agent
-email_agent = EmailTriageAgent()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the push micro-batcher and snapshot pending sessions on shutdown."""
+    push_batcher.start()
+    yield
+    # uvicorn has already spent up to REQUEST_DRAIN_SECONDS on open requests
+    started = time.monotonic()
+    # Merge this worker's unsaved sender counts into the shared file
+    email_agent.sender_history.save()
+    try:
+        session_snapshot.save(pending_responses, email_agent)
+    except Exception as e:
+        logger.error(f"Error writing session snapshot: {e}")
+    # Push requests are closed by now, so unfinished emails are redelivered by Pub/Sub anyway
+    remaining = SHUTDOWN_DRAIN_SECONDS - REQUEST_DRAIN_SECONDS - (time.monotonic() - started)
+    try:
+        await asyncio.wait_for(push_batcher.stop(), timeout=max(remaining, 0))
+    except asyncio.TimeoutError:
+        logger.warning("Push queue not drained before the shutdown deadline")
+
+app = FastAPI(title="Email Triage Agent", version="1.0.0", lifespan=lifespan)
+
+# Initialize the email agent; with SESSION_DB_PATH set, sessions are shared
+# with the other worker processes through SQLite
+email_agent = EmailTriageAgent(checkpointer=create_checkpointer())
 
 # Store for pending email responses
-pending_responses: Dict[str, Dict[str, Any]] = {}
+pending_responses: MutableMapping[str, Dict[str, Any]] = create_session_store()
+
+# Pending sessions saved by the previous instance on SIGTERM, loaded on first miss
+session_snapshot = SessionSnapshot.from_env()
 
 class EmailRequest(BaseModel):
     author: str
     to: str
     subject: str
     email_thread: str
+    # Optional thread identity; follow-ups in the same thread are triaged incrementally
+    thread_key: Optional[str] = None
+    message_id: Optional[str] = None
+    in_reply_to: Optional[str] = None
+    references: Optional[str] = None
+    # Budget key for TENANT_TOKENS_PER_MINUTE; defaults to the recipient's domain
+    tenant: Optional[str] = None
 
 class EmailResponse(BaseModel):
     triage_decision: str
     needs_response: bool
     drafted_response: Optional[str] = None
     session_id: Optional[str] = None
+    thread_key: Optional[str] = None
+    token_usage: Optional[Dict[str, Any]] = None
     message: str
 
 class EmailApprovalRequest(BaseModel):
     session_id: str
     approve_email: bool
 
+# Size of the reads used to stream raw messages into the MIME parser
+RAW_EMAIL_CHUNK_SIZE = 64 * 1024
+
 @app.post("/triage_email", response_model=EmailResponse)
 async def triage_email(email_data: EmailRequest):
     """Analyze an email and determine the triage decision."""
+    return _triage_email_data(email_data)
+
+def _triage_email_data(email_data: EmailRequest) -> EmailResponse:
+    """Run one email through the agent and track it for approval if it needs a response."""
     logger.info(f"Processing email from {email_data.author} with subject: {email_data.subject}")
     try:
         # Generate a unique session ID for this email
         session_id = str(uuid.uuid4())
         logger.info(f"Generated session ID: {session_id}")
         
+        thread_key = email_data.thread_key or derive_thread_key(
+            email_data.message_id, email_data.in_reply_to, email_data.references
+        )
+        
         # Process the email through the agent
         logger.info("Sending email to agent for processing...")
         result = email_agent.process_email(
@@ -51,7 +110,9 @@ async def triage_email(email_data: EmailRequest):
             to=email_data.to,
             subject=email_data.subject,
             email_thread=email_data.email_thread,
-            session_id=session_id
+            session_id=session_id,
+            thread_key=thread_key,
+            tenant=email_data.tenant
         )
         
         # Store the session for potential response approval
@@ -59,7 +120,8 @@ async def triage_email(email_data: EmailRequest):
             pending_responses[session_id] = {
                 "email_data": email_data.dict(),
                 "drafted_response": result.get("drafted_response"),
-                "triage_decision": result.get("triage_decision")
+                "triage_decision": result.get("triage_decision"),
+                "created": time.time()
             }
         
         return EmailResponse(
@@ -67,19 +129,87 @@ async def triage_email(email_data: EmailRequest):
             needs_response=result.get("needs_response", False),
             drafted_response=result.get("drafted_response"),
             session_id=session_id if result.get("needs_response") else None,
+            thread_key=thread_key,
+            token_usage=result.get("token_usage"),
             message=result.get("message", "Email processed successfully")
         )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing email: {str(e)}")
 
+def _email_request_from_parsed(parsed: Dict[str, Any]) -> EmailRequest:
+    """Build a triage request from a parsed raw message; 400 if it has no headers or no text."""
+    if not (parsed["author"] or parsed["subject"]):
+        raise HTTPException(status_code=400, detail="Raw email has no From or Subject header")
+    if not parsed["email_thread"].strip():
+        raise HTTPException(status_code=400, detail="Raw email has no text body")
+    logger.info(f"Parsed raw email, skipped {parsed['skipped_parts']} attachment parts ({parsed['skipped_bytes']} bytes)")
+    return EmailRequest(
+        author=parsed["author"],
+        to=parsed["to"],
+        subject=parsed["subject"],
+        email_thread=parsed["email_thread"],
+        message_id=parsed["message_id"] or None,
+        in_reply_to=parsed["in_reply_to"] or None,
+        references=parsed["references"] or None
+    )
+
+@app.post("/triage_raw_email", response_model=EmailResponse)
+async def triage_raw_email(request: Request):
+    """Triage a raw RFC 822/MIME message sent as the request body."""
+    parser = StreamingMessageParser()
+    try:
+        async for chunk in request.stream():
+            parser.feed(chunk)
+        parsed = parser.close()
+    except HeaderLimitExceeded as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _triage_email_data(_email_request_from_parsed(parsed))
+
+@app.post("/triage_raw_email_batch", response_model=List[EmailResponse])
+async def triage_raw_email_batch(files: List[UploadFile] = File(...)):
+    """Triage several raw RFC 822/MIME messages uploaded as multipart form files.
+
+    Starlette spools each upload to a temporary file (in memory up to 1 MB, then
+    on disk) before this handler runs; the parser then reads it back in chunks.
+    A message that fails is reported in its own entry without failing the batch.
+    """
+    responses = []
+    for upload in files:
+        parser = StreamingMessageParser()
+        try:
+            while True:
+                chunk = await upload.read(RAW_EMAIL_CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+            responses.append(_triage_email_data(_email_request_from_parsed(parser.close())))
+        except HTTPException as e:
+            responses.append(_batch_error(upload.filename, e.detail))
+        except HeaderLimitExceeded as e:
+            responses.append(_batch_error(upload.filename, str(e)))
+        except Exception as e:
+            responses.append(_batch_error(upload.filename, f"Error parsing message: {str(e)}"))
+        finally:
+            await upload.close()
+    return responses
+
+def _batch_error(filename: Optional[str], detail: str) -> EmailResponse:
+    return EmailResponse(
+        triage_decision="error",
+        needs_response=False,
+        message=f"{filename or 'message'}: {detail}"
+    )
+
 @app.post("/triage_email_response", response_model=EmailResponse)
 async def triage_email_response(approval: EmailApprovalRequest):
     """Handle user approval/rejection of drafted email response."""
     try:
         session_id = approval.session_id
         
-        if session_id not in pending_responses:
+        if session_id not in pending_responses and not session_snapshot.restore(
+            session_id, pending_responses, email_agent
+        ):
             raise HTTPException(status_code=404, detail="Session not found")
         
         session_data = pending_responses[session_id]
@@ -108,28 +238,83 @@ async def triage_email_response(approval: EmailApprovalRequest):
                 needs_response=True,
                 drafted_response=result,
                 session_id=session_id,
+                token_usage=email_agent.get_session_usage(session_id),
                 message="New email draft generated. Please review and approve."
             )
             
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing response: {str(e)}")
 
+def _triage_push_email(fields: Dict[str, Any]) -> bool:
+    try:
+        response = _triage_email_data(EmailRequest(**fields))
+        logger.info(f"Push email triaged as {response.triage_decision} (session {response.session_id})")
+        return response.triage_decision != "error"
+    except Exception as e:
+        logger.error(f"Error triaging push email from {fields.get('author')}: {e}")
+        return False
+
+async def _process_push_batch(batch: List[Dict[str, Any]]) -> List[bool]:
+    """Triage one micro-batch of pushed emails concurrently in worker threads."""
+    logger.info(f"Processing push batch of {len(batch)} emails")
+    return await asyncio.gather(*(asyncio.to_thread(_triage_push_email, fields) for fields in batch))
+
+# Collects Pub/Sub push messages into micro-batches
+push_batcher = MicroBatcher.from_env(_process_push_batch)
+
+@app.post("/pubsub/push", status_code=204)
+async def pubsub_push(envelope: Dict[str, Any]):
+    """Queue a Pub/Sub push message for batched triage and acknowledge it once triaged.
+
+    A full queue answers 429 and a failed triage 503, so Pub/Sub backs off and
+    redelivers the message instead of losing it.
+    """
+    message_id, email = decode_push_envelope(envelope)
+    try:
+        result = push_batcher.submit(message_id, email)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=429, detail="Push queue is full; retry later")
+    # Shielded so a dropped connection does not cancel the batch's result for other waiters
+    if result is not None and not await asyncio.shield(result):
+        raise HTTPException(status_code=503, detail="Triage failed; retry later")
+    return Response(status_code=204)
+
+@app.get("/usage")
+async def usage_report():
+    """Token and cost aggregates per node and sender domain, with the configured budgets."""
+    return {**email_agent.usage.report(), "prompt_versions": email_agent.prompts.versions()}
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
-    return {"status": "healthy", "pending_sessions": len(pending_responses)}
+    return {
+        "status": "healthy",
+        "pending_sessions": len(pending_responses),
+        "near_duplicates": email_agent.near_duplicates.stats(),
+        "sender_history": email_agent.sender_history.stats(),
+        "local_classifier": email_agent.local_classifier.stats(),
+        "push": push_batcher.status(),
+        "snapshot": session_snapshot.stats()
+    }
 
 if __name__ == "__main__":
     import uvicorn
-    import os
     
     # Get port from environment variable (Cloud Run sets PORT)
     port = int(os.environ.get("PORT", 8000))
+    workers = int(os.environ.get("WORKERS", 1))
+    
+    if workers > 1:
+        # Workers only share approvals through a common session database
+        os.environ.setdefault("SESSION_DB_PATH", "/tmp/email_agent_sessions.db")
+        logger.info(f"Starting {workers} workers sharing sessions in {os.environ['SESSION_DB_PATH']}")
     
     uvicorn.run(
-        app, 
+        "main:app" if workers > 1 else app,
         host="0.0.0.0", 
         port=port,
+        workers=workers,
+        timeout_graceful_shutdown=REQUEST_DRAIN_SECONDS,
         log_level="info",
         access_log=True
     )
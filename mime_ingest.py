@@ -0,0 +1,256 @@
+from typing import Dict, Any, Optional, List, Iterable
+from email import policy
+from email.parser import BytesHeaderParser
+from html.parser import HTMLParser
+import base64
+import binascii
+import logging
+import os
+import quopri
+
+logger = logging.getLogger(__name__)
+
+MAX_TEXT_BYTES = int(os.getenv("MIME_MAX_TEXT_BYTES", str(1024 * 1024)))
+# RFC 5322 limits lines to 998 characters; longer partial lines cannot be boundaries
+MAX_LINE_BYTES = 4096
+# Header blocks are buffered until their blank line, so both their lines and their total size are capped
+MAX_HEADER_LINE_BYTES = 32 * 1024
+MAX_HEADER_BYTES = int(os.getenv("MIME_MAX_HEADER_BYTES", str(256 * 1024)))
+
+
+class HeaderLimitExceeded(ValueError):
+    """A header line or header block is larger than the parser will buffer."""
+
+
+class _HTMLTextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.parts: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self._skip += 1
+        elif tag in ("br", "p", "div", "tr", "li"):
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style") and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def html_to_text(html: str) -> str:
+    extractor = _HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return "".join(extractor.parts).strip()
+
+
+class _Part:
+    """Headers and body handling for one MIME part."""
+
+    def __init__(self, headers):
+        self.content_type = headers.get_content_type()
+        self.boundary = headers.get_boundary()
+        self.charset = headers.get_content_charset() or "utf-8"
+        self.encoding = str(headers.get("Content-Transfer-Encoding", "7bit")).strip().lower()
+        self.is_attachment = str(headers.get("Content-Disposition", "")).strip().lower().startswith("attachment")
+        self.body: Optional[List[bytes]] = None
+        self.size = 0
+        self.skipped_bytes = 0
+
+    @property
+    def is_multipart(self) -> bool:
+        return self.content_type.startswith("multipart/") and bool(self.boundary)
+
+    def decode(self) -> str:
+        data = b"".join(self.body or [])
+        if self.encoding == "base64":
+            try:
+                data = base64.b64decode(data)
+            except (binascii.Error, ValueError):
+                data = b""
+        elif self.encoding == "quoted-printable":
+            data = quopri.decodestring(data)
+        try:
+            return data.decode(self.charset, errors="replace")
+        except LookupError:
+            return data.decode("utf-8", errors="replace")
+
+
+class StreamingMessageParser:
+    """Incremental RFC 822/MIME parser that keeps headers and text parts and skips everything else.
+
+    Feed the raw message in chunks of any size. Only header blocks and up to
+    MAX_TEXT_BYTES of the first text/plain and text/html parts are buffered;
+    attachment bodies are counted and dropped as they stream past. A header
+    line over MAX_HEADER_LINE_BYTES or a header block over max_header_bytes
+    raises HeaderLimitExceeded.
+    """
+
+    def __init__(self, max_text_bytes: int = MAX_TEXT_BYTES, max_header_bytes: int = MAX_HEADER_BYTES):
+        self.max_text_bytes = max_text_bytes
+        self.max_header_bytes = max_header_bytes
+        self.headers = None
+        self.plain: Optional[str] = None
+        self.html: Optional[str] = None
+        self.skipped_parts = 0
+        self.skipped_bytes = 0
+        self._partial = b""
+        self._header_lines: List[bytes] = []
+        self._header_bytes = 0
+        self._in_headers = True
+        self._part: Optional[_Part] = None
+        self._boundaries: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> None:
+        data = self._partial + chunk
+        self._partial = b""
+        start, end = 0, len(data)
+        while start < end:
+            if not self._in_headers and not self._keeps_body() and not data.startswith(b"--", start):
+                # Only lines starting with "--" can end a skipped part, so drop everything before one
+                boundary_line = data.find(b"\n--", start)
+                if boundary_line == -1:
+                    last_newline = data.rfind(b"\n", start)
+                    if last_newline != -1:
+                        self._skip_bytes(last_newline + 1 - start)
+                        start = last_newline + 1
+                    self._partial = data[start:]
+                    break
+                self._skip_bytes(boundary_line + 1 - start)
+                start = boundary_line + 1
+                continue
+            newline = data.find(b"\n", start)
+            if newline == -1:
+                self._partial = data[start:]
+                break
+            self._line(data[start:newline + 1])
+            start = newline + 1
+        if len(self._partial) > MAX_LINE_BYTES and not self._in_headers:
+            self._body(self._partial)
+            self._partial = b""
+        elif len(self._partial) > MAX_HEADER_LINE_BYTES and self._in_headers:
+            raise HeaderLimitExceeded(f"Header line longer than {MAX_HEADER_LINE_BYTES} bytes")
+
+    def close(self) -> Dict[str, Any]:
+        if self._partial:
+            self._line(self._partial)
+            self._partial = b""
+        if self._in_headers and self._header_lines:
+            self._start_part()
+        self._finish_part()
+        return self.result()
+
+    def _keeps_body(self) -> bool:
+        return self._part is not None and self._part.body is not None
+
+    def _skip_bytes(self, size: int) -> None:
+        self.skipped_bytes += size
+        if self._part is not None:
+            self._part.skipped_bytes += size
+
+    def _line(self, line: bytes) -> None:
+        if self._in_headers:
+            if line.strip():
+                if len(line) > MAX_HEADER_LINE_BYTES:
+                    raise HeaderLimitExceeded(f"Header line longer than {MAX_HEADER_LINE_BYTES} bytes")
+                self._header_bytes += len(line)
+                if self._header_bytes > self.max_header_bytes:
+                    raise HeaderLimitExceeded(f"Header block larger than {self.max_header_bytes} bytes")
+                self._header_lines.append(line)
+            else:
+                self._start_part()
+            return
+
+        if self._boundaries and line.startswith(b"--"):
+            marker = line.rstrip()
+            for depth in range(len(self._boundaries) - 1, -1, -1):
+                boundary = self._boundaries[depth]
+                if marker == boundary + b"--":
+                    self._finish_part()
+                    del self._boundaries[depth:]
+                    self._part = None
+                    return
+                if marker == boundary:
+                    self._finish_part()
+                    del self._boundaries[depth + 1:]
+                    self._in_headers = True
+                    return
+
+        self._body(line)
+
+    def _body(self, data: bytes) -> None:
+        if self._keeps_body():
+            if self._part.size + len(data) <= self.max_text_bytes:
+                self._part.body.append(data)
+                self._part.size += len(data)
+        else:
+            self._skip_bytes(len(data))
+
+    def _start_part(self) -> None:
+        headers = BytesHeaderParser(policy=policy.default).parsebytes(b"".join(self._header_lines))
+        self._header_lines = []
+        self._header_bytes = 0
+        self._in_headers = False
+        if self.headers is None:
+            self.headers = headers
+        part = _Part(headers)
+        self._part = part
+        if part.is_multipart:
+            self._boundaries.append(b"--" + part.boundary.encode("utf-8", errors="replace"))
+        elif not part.is_attachment and (
+            (part.content_type == "text/plain" and self.plain is None)
+            or (part.content_type == "text/html" and self.html is None)
+        ):
+            part.body = []
+
+    def _finish_part(self) -> None:
+        part = self._part
+        if part is None or part.is_multipart:
+            return
+        if part.body is not None:
+            text = part.decode()
+            if part.content_type == "text/plain" and self.plain is None:
+                self.plain = text
+            elif part.content_type == "text/html" and self.html is None:
+                self.html = text
+        elif part.skipped_bytes or part.is_attachment:
+            self.skipped_parts += 1
+        self._part = None
+
+    def result(self) -> Dict[str, Any]:
+        """Return the triage fields, preferring text/plain over text/html."""
+        headers = self.headers
+        get = (lambda name: str(headers.get(name, "")).strip()) if headers is not None else (lambda name: "")
+        if self.plain is not None:
+            email_thread = self.plain
+        elif self.html is not None:
+            email_thread = html_to_text(self.html)
+        else:
+            email_thread = ""
+        return {
+            "author": get("From"),
+            "to": get("To"),
+            "subject": get("Subject"),
+            "email_thread": email_thread,
+            "message_id": get("Message-ID"),
+            "in_reply_to": get("In-Reply-To"),
+            "references": get("References"),
+            "skipped_parts": self.skipped_parts,
+            "skipped_bytes": self.skipped_bytes,
+        }
+
+
+def parse_raw_email(chunks: Iterable[bytes], max_text_bytes: int = MAX_TEXT_BYTES) -> Dict[str, Any]:
+    """Parse a raw message given as bytes or an iterable of byte chunks."""
+    parser = StreamingMessageParser(max_text_bytes=max_text_bytes)
+    if isinstance(chunks, (bytes, bytearray)):
+        chunks = [chunks]
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
@@ -0,0 +1,144 @@
+from typing import Dict, Any, Optional, List, Tuple
+from collections import OrderedDict
+import logging
+import os
+import re
+import struct
+import threading
+
+from response_parser import SHORT_CIRCUIT_DECISIONS
+
+logger = logging.getLogger(__name__)
+
+# Tokens that vary between copies of the same templated email
+URL_RE = re.compile(r"(?:https?://|www\.)\S+", re.IGNORECASE)
+EMAIL_RE = re.compile(r"\b[\w.+-]+@[\w-]+\.[\w.-]+\b")
+NUMBER_RE = re.compile(r"\d+(?:[.,:/-]\d+)*")
+WORD_RE = re.compile(r"[a-z_]+")
+
+FINGERPRINT_BITS = 64
+
+
+def normalize_email_text(subject: str, email_thread: str) -> List[str]:
+    """Lowercase the email and replace links, addresses and numbers with placeholders."""
+    text = f"{subject}\n{email_thread}".lower()
+    text = URL_RE.sub(" _url_ ", text)
+    text = EMAIL_RE.sub(" _email_ ", text)
+    text = NUMBER_RE.sub(" _num_ ", text)
+    return WORD_RE.findall(text)
+
+
+def simhash(tokens: List[str]) -> int:
+    """Compute a 64-bit SimHash over 3-word shingles.
+
+    Shingles are hashed with Python's tuple hash, which is only stable within a
+    process; fingerprints are never persisted or shared between workers.
+    """
+    if len(tokens) < 3:
+        tokens = (list(tokens) + ["", ""])[:3]
+    hashes = list(map(hash, zip(tokens, tokens[1:], tokens[2:])))
+    packed = struct.pack(f"<{len(hashes)}q", *hashes)
+
+    # packed[k::8] is byte k of every hash (columns 8k..8k+7) read as one big
+    # integer; masking one bit of every byte and popcounting counts a column
+    threshold = len(hashes) // 2
+    ones = int.from_bytes(b"\x01" * len(hashes), "little")
+    fingerprint = 0
+    for k in range(8):
+        column_bytes = int.from_bytes(packed[k::8], "little")
+        for bit in range(8):
+            if (column_bytes >> bit & ones).bit_count() > threshold:
+                fingerprint |= 1 << (8 * k + bit)
+    return fingerprint
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class NearDuplicateIndex:
+    """Bounded SimHash index with banded LSH lookup of recent FYI/discard decisions."""
+
+    def __init__(self, max_distance: int = 6, bands: int = 8, max_entries: int = 10000, enabled: bool = True):
+        if FINGERPRINT_BITS % bands != 0:
+            raise ValueError(f"bands must divide {FINGERPRINT_BITS}")
+        if max_distance >= bands:
+            # With fewer differing bits than bands at least one band matches exactly
+            logger.warning(f"max_distance={max_distance} >= bands={bands}; some near duplicates may be missed")
+        self.enabled = enabled
+        self.max_distance = max_distance
+        self.bands = bands
+        self.band_bits = FINGERPRINT_BITS // bands
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, str]" = OrderedDict()
+        self._buckets: List[Dict[int, set]] = [{} for _ in range(bands)]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> "NearDuplicateIndex":
+        """Create an index configured from NEAR_DUPLICATE_* environment variables."""
+        return cls(
+            max_distance=int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "6")),
+            bands=int(os.getenv("NEAR_DUPLICATE_BANDS", "8")),
+            max_entries=int(os.getenv("NEAR_DUPLICATE_MAX_ENTRIES", "10000")),
+            enabled=os.getenv("NEAR_DUPLICATE_ENABLED", "true").lower() == "true",
+        )
+
+    def fingerprint(self, subject: str, email_thread: str) -> int:
+        return simhash(normalize_email_text(subject, email_thread))
+
+    def _band_keys(self, fingerprint: int) -> List[Tuple[int, int]]:
+        mask = (1 << self.band_bits) - 1
+        return [(band, fingerprint >> (band * self.band_bits) & mask) for band in range(self.bands)]
+
+    def lookup(self, fingerprint: int) -> Optional[str]:
+        """Return the decision of the closest indexed email within max_distance, if any."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            best, best_distance = None, self.max_distance + 1
+            for band, key in self._band_keys(fingerprint):
+                for candidate in self._buckets[band].get(key, ()):
+                    distance = hamming_distance(fingerprint, candidate)
+                    if distance < best_distance:
+                        best, best_distance = candidate, distance
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best)
+            return self._entries[best]
+
+    def add(self, fingerprint: int, decision: str) -> None:
+        """Record an LLM triage decision; only FYI and discard decisions are kept."""
+        if not self.enabled or decision not in SHORT_CIRCUIT_DECISIONS:
+            return
+        with self._lock:
+            if fingerprint in self._entries:
+                self._entries[fingerprint] = decision
+                self._entries.move_to_end(fingerprint)
+                return
+            self._entries[fingerprint] = decision
+            for band, key in self._band_keys(fingerprint):
+                self._buckets[band].setdefault(key, set()).add(fingerprint)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._remove_from_buckets(evicted)
+
+    def _remove_from_buckets(self, fingerprint: int) -> None:
+        for band, key in self._band_keys(fingerprint):
+            bucket = self._buckets[band].get(key)
+            if bucket is not None:
+                bucket.discard(fingerprint)
+                if not bucket:
+                    del self._buckets[band][key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
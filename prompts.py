@@ -0,0 +1,157 @@
+from typing import Dict, Any, List, Optional, Tuple
+from string import Formatter
+import logging
+import os
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+logger = logging.getLogger(__name__)
+
+# Versioned prompt templates: (static system prefix, per-email template).
+# The system prefix never contains per-email data, so every call for a template
+# starts with the same bytes and providers can serve it from their prompt cache.
+# Bump the version instead of editing a template in place.
+PROMPT_TEMPLATES: Dict[str, Dict[int, Tuple[str, str]]] = {
+    "triage": {
+        1: (
+            "You triage incoming email for a busy professional.\n"
+            "Classify each email in exactly one of the following categories:\n"
+            "1. FYI (no response needed)\n"
+            "2. Discard (spam/unimportant)\n"
+            "3. Respond (requires action)\n"
+            "\n"
+            "Start your answer with the category name.\n"
+            "If a response is needed, insert a line that says \"professional response:\" "
+            "and then draft a professional response starting on the next line.\n"
+            "When asked for a thread summary, begin your answer with a line that says "
+            "\"thread summary:\" followed by a short summary of the whole thread, including the new message.",
+            "Author: {author}\n"
+            "To: {to}\n"
+            "Subject: {subject}\n"
+            "{email_content}"
+            "{summary_request}",
+        ),
+        # The summary line goes after the category so it does not compete with "start with the category"
+        2: (
+            "You triage incoming email for a busy professional.\n"
+            "Classify each email in exactly one of the following categories:\n"
+            "1. FYI (no response needed)\n"
+            "2. Discard (spam/unimportant)\n"
+            "3. Respond (requires action)\n"
+            "\n"
+            "Start your answer with the category name.\n"
+            "When asked for a thread summary, put it on its own line after the category name: "
+            "\"thread summary:\" followed by a short summary of the whole thread, including the new message.\n"
+            "If a response is needed, insert a line that says \"professional response:\" "
+            "and then draft a professional response starting on the next line.",
+            "Author: {author}\n"
+            "To: {to}\n"
+            "Subject: {subject}\n"
+            "{email_content}"
+            "{summary_request}",
+        ),
+    },
+    "triage_structured": {
+        1: (
+            "You triage incoming email for a busy professional.\n"
+            "Classify each email in exactly one of the following categories:\n"
+            "respond (requires action), fyi (no response needed), discard (spam/unimportant).\n"
+            "\n"
+            "Answer by calling the TriageOutput function, or if functions are unavailable with only a JSON object "
+            "of the form {\"category\": \"respond\" | \"fyi\" | \"discard\", \"draft\": string or null, "
+            "\"thread_summary\": string or null}.\n"
+            "For respond, put a professional response in draft; otherwise set draft to null.\n"
+            "When asked for a thread summary, put a short summary of the whole thread, including the new message, "
+            "in thread_summary; otherwise set it to null.",
+            "Author: {author}\n"
+            "To: {to}\n"
+            "Subject: {subject}\n"
+            "{email_content}"
+            "{summary_request}",
+        ),
+    },
+    "draft": {
+        1: (
+            "You write replies to email for a busy professional.\n"
+            "Write a new response to the email below. Make sure it is professional and appropriate.\n"
+            "Answer with the text of the response only.",
+            "Author: {author}\n"
+            "Subject: {subject}\n"
+            "{email_content}",
+        ),
+    },
+}
+
+THREAD_SUMMARY_REQUEST = "\n\nInclude a thread summary."
+
+
+def email_content(values: Dict[str, Any]) -> str:
+    """Per-email body block: the full thread, or the summary and new message for follow-ups."""
+    if values.get('new_message') is not None:
+        return (f"Thread Summary So Far: {values.get('thread_summary')}\n"
+                f"Previous Triage Decision: {values.get('prior_decision')}\n"
+                f"New Message: {values.get('new_message')}")
+    return f"Email Thread: {values.get('email_thread', 'Unknown')}"
+
+
+class CompiledPrompt:
+    """A prompt template parsed once into literal chunks and field names."""
+
+    def __init__(self, name: str, version: int, system: str, template: str):
+        self.name = name
+        self.version = version
+        self.system_message = SystemMessage(content=system)
+        self._parts: List[Tuple[str, Optional[str]]] = [
+            (literal, field) for literal, field, _, _ in Formatter().parse(template)
+        ]
+        self.fields = [field for _, field in self._parts if field]
+
+    def render(self, **values: Any) -> List[BaseMessage]:
+        """Return [static system prefix, per-email message]; the system message object is shared."""
+        content = "".join(
+            literal + (str(values[field]) if field else "") for literal, field in self._parts
+        )
+        return [self.system_message, HumanMessage(content=content)]
+
+
+class PromptLibrary:
+    """Templates compiled at startup, one selected version per prompt name."""
+
+    def __init__(self, versions: Optional[Dict[str, int]] = None):
+        versions = versions or {}
+        self.prompts: Dict[str, CompiledPrompt] = {}
+        for name, by_version in PROMPT_TEMPLATES.items():
+            version = versions.get(name, max(by_version))
+            if version not in by_version:
+                raise ValueError(f"Unknown version {version} for prompt '{name}'")
+            self.prompts[name] = CompiledPrompt(name, version, *by_version[version])
+        logger.info(f"Compiled prompt templates: {self.versions()}")
+
+    @classmethod
+    def from_env(cls) -> "PromptLibrary":
+        """Create a library pinned by PROMPT_VERSIONS, e.g. "triage=1,draft=1"; latest versions otherwise."""
+        versions = {}
+        for item in os.getenv("PROMPT_VERSIONS", "").split(","):
+            if "=" in item:
+                name, version = item.split("=", 1)
+                versions[name.strip()] = int(version)
+        return cls(versions)
+
+    def versions(self) -> Dict[str, int]:
+        return {name: prompt.version for name, prompt in self.prompts.items()}
+
+    def triage(self, values: Dict[str, Any], structured: bool = False) -> List[BaseMessage]:
+        return self.prompts["triage_structured" if structured else "triage"].render(
+            author=values['author'],
+            to=values['to'],
+            subject=values['subject'],
+            email_content=email_content(values),
+            summary_request=THREAD_SUMMARY_REQUEST if values.get('thread_key') else "",
+        )
+
+    def draft(self, values: Dict[str, Any]) -> List[BaseMessage]:
+        return self.prompts["draft"].render(
+            author=values.get('author', 'Unknown'),
+            subject=values.get('subject', 'Unknown'),
+            email_content=email_content(values),
+        )
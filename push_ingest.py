@@ -0,0 +1,206 @@
+from typing import Dict, Any, Optional, List, Tuple, Callable, Awaitable
+from collections import OrderedDict
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import time
+
+from mime_ingest import HeaderLimitExceeded, parse_raw_email
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ("author", "to", "subject", "email_thread")
+EMAIL_FIELDS = ("author", "to", "subject", "email_thread", "thread_key", "message_id", "in_reply_to", "references")
+
+
+def decode_push_envelope(envelope: Dict[str, Any]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """Decode a Pub/Sub push envelope into (message ID, email fields).
+
+    The message data may be a JSON object with the /triage_email fields or a
+    raw RFC 822 message. Returns None fields for payloads that carry no email,
+    such as bare Gmail watch notifications.
+    """
+    message = envelope.get("message") or {}
+    message_id = message.get("messageId") or message.get("message_id")
+    try:
+        data = base64.b64decode(message.get("data", ""), validate=False)
+    except (binascii.Error, ValueError):
+        logger.warning(f"Undecodable Pub/Sub data for message {message_id}")
+        return message_id, None
+
+    stripped = data.lstrip()
+    if stripped.startswith(b"{"):
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            logger.warning(f"Invalid JSON in Pub/Sub message {message_id}")
+            return message_id, None
+        if "email_thread" not in payload:
+            # For example a Gmail watch notification with only emailAddress/historyId
+            logger.info(f"Pub/Sub message {message_id} has no email content; skipping")
+            return message_id, None
+        return message_id, {key: payload[key] for key in EMAIL_FIELDS if payload.get(key) is not None}
+    if not stripped:
+        return message_id, None
+
+    try:
+        parsed = parse_raw_email(data)
+    except HeaderLimitExceeded as e:
+        logger.warning(f"Skipping Pub/Sub message {message_id}: {e}")
+        return message_id, None
+    return message_id, {key: parsed[key] for key in EMAIL_FIELDS if key in REQUIRED_FIELDS or parsed.get(key)}
+
+
+class RecentIds:
+    """Bounded set of recently seen message IDs for deduplicating redeliveries.
+
+    The set is per process; with several workers a redelivery that reaches a
+    different worker is not recognized.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._ids
+
+    def add(self, message_id: str) -> bool:
+        """Remember an ID; returns False if it was already seen."""
+        if message_id in self._ids:
+            self._ids.move_to_end(message_id)
+            return False
+        self._ids[message_id] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return True
+
+
+class MicroBatcher:
+    """Collect pushed emails and hand them to a batch processor by size or time window.
+
+    process_batch returns one success flag per email. submit() hands back a
+    future with that flag, so the push request is only acknowledged once its
+    email was triaged; a failure, or a queue that is never drained, leaves the
+    message unacknowledged for Pub/Sub to redeliver. Message IDs are
+    remembered for deduplication only after a successful triage.
+    """
+
+    def __init__(self, process_batch: Callable[[List[Dict[str, Any]]], Awaitable[List[bool]]],
+                 max_batch_size: int = 10, max_wait_seconds: float = 1.0, dedup_size: int = 10000,
+                 max_queue_size: int = 1000):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.max_queue_size = max_queue_size
+        self.recent_ids = RecentIds(dedup_size)
+        # Futures of queued emails by message ID; redeliveries wait on the same future
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"received": 0, "duplicates": 0, "skipped": 0, "rejected": 0,
+                      "batches": 0, "processed": 0, "failed": 0}
+
+    @classmethod
+    def from_env(cls, process_batch) -> "MicroBatcher":
+        """Create a batcher configured from PUSH_* environment variables."""
+        return cls(
+            process_batch,
+            max_batch_size=int(os.getenv("PUSH_BATCH_SIZE", "10")),
+            max_wait_seconds=float(os.getenv("PUSH_BATCH_WAIT_SECONDS", "1.0")),
+            dedup_size=int(os.getenv("PUSH_DEDUP_SIZE", "10000")),
+            max_queue_size=int(os.getenv("PUSH_QUEUE_MAX_SIZE", "1000")),
+        )
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue(self.max_queue_size)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Process everything already queued, then stop the background task."""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def submit(self, message_id: Optional[str], email: Optional[Dict[str, Any]]) -> Optional[asyncio.Future]:
+        """Queue a decoded push message and return a future resolving to whether its triage succeeded.
+
+        Returns None for empty payloads and already triaged duplicates, which
+        can be acknowledged right away. A redelivery of a queued message gets
+        the original's future. Raises asyncio.QueueFull when the queue is at
+        capacity so the caller can refuse the message.
+        """
+        self.stats["received"] += 1
+        if message_id and message_id in self.recent_ids:
+            self.stats["duplicates"] += 1
+            return None
+        if message_id and message_id in self._in_flight:
+            self.stats["duplicates"] += 1
+            return self._in_flight[message_id]
+        if email is None:
+            self.stats["skipped"] += 1
+            if message_id:
+                self.recent_ids.add(message_id)
+            return None
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((message_id, email, future))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise
+        if message_id:
+            self._in_flight[message_id] = future
+        return future
+
+    async def _run(self) -> None:
+        stopping = False
+        try:
+            while not stopping:
+                item = await self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.max_wait_seconds
+                while len(batch) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                await self._flush(batch)
+        finally:
+            # Emails still queued when the drain is cut short are reported as failed, not acknowledged
+            for future in self._in_flight.values():
+                if not future.done():
+                    future.set_result(False)
+            self._in_flight.clear()
+
+    async def _flush(self, batch: List[Tuple[Optional[str], Dict[str, Any], asyncio.Future]]) -> None:
+        self.stats["batches"] += 1
+        try:
+            results = await self.process_batch([email for _, email, _ in batch])
+        except Exception as e:
+            logger.error(f"Error processing push batch of {len(batch)}: {e}")
+            results = [False] * len(batch)
+        for (message_id, _, future), ok in zip(batch, results):
+            self.stats["processed" if ok else "failed"] += 1
+            if message_id:
+                self._in_flight.pop(message_id, None)
+                if ok:
+                    self.recent_ids.add(message_id)
+            if not future.done():
+                future.set_result(bool(ok))
+
+    def status(self) -> Dict[str, Any]:
+        return {**self.stats, "queued": self._queue.qsize() if self._queue else 0}
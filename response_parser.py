@@ -0,0 +1,113 @@
+from typing import Any, Literal, Optional
+import json
+import logging
+import re
+
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+
+from thread_context import extract_thread_summary, strip_thread_summary
+
+logger = logging.getLogger(__name__)
+
+# Decisions that never need a human; only these may be answered without the LLM
+SHORT_CIRCUIT_DECISIONS = ("fyi", "discard")
+
+FALLBACK_DRAFT = "Thank you for your email. I will review this and get back to you shortly."
+
+# The category is the first category word; draft markers are found with str.find
+# on one lowercased copy and only consulted for "respond" answers. Word
+# boundaries keep "no response needed" from being read as "respond".
+DRAFT_MARKERS = ("professional response:", "draft:")
+CATEGORY_RE = re.compile(r"\b(?:(?P<respond>respond)|(?P<fyi>fyi|no response)|(?P<discard>discard))\b")
+
+
+class TriageOutput(BaseModel):
+    """Strict schema for structured triage answers (JSON content or a function call)."""
+
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True)
+
+    category: Literal["respond", "fyi", "discard"]
+    draft: Optional[str] = None
+    thread_summary: Optional[str] = None
+
+    @field_validator("category", mode="before")
+    @classmethod
+    def _lowercase_category(cls, value: Any) -> Any:
+        return value.strip().lower() if isinstance(value, str) else value
+
+
+def parse_free_text(content: str) -> TriageOutput:
+    """Parse a free-text answer: the leading category word wins, and a respond answer's draft follows its marker."""
+    lowered = content.lower()
+    marker_start, marker_end = -1, -1
+    for marker in DRAFT_MARKERS:
+        position = lowered.find(marker)
+        if position != -1 and (marker_start == -1 or position < marker_start):
+            marker_start, marker_end = position, position + len(marker)
+
+    # Only text before the draft can name the category; a bare draft means respond
+    match = CATEGORY_RE.search(lowered, 0, marker_start if marker_start != -1 else len(lowered))
+    if match:
+        category = match.lastgroup
+    else:
+        category = "respond" if marker_start != -1 else "discard"
+    if category != "respond":
+        return TriageOutput(category=category)
+
+    draft = ""
+    if marker_start != -1:
+        draft = "\n".join(line.strip() for line in content[marker_end:].split("\n")).strip()
+    return TriageOutput(category="respond", draft=draft or FALLBACK_DRAFT)
+
+
+def parse_structured(payload: Any) -> Optional[TriageOutput]:
+    """Validate a function-call argument dict or a JSON string against the schema; None if it does not fit."""
+    try:
+        if isinstance(payload, dict):
+            return TriageOutput.model_validate(payload)
+        text = payload.strip()
+        if text.startswith("```"):
+            # Some models wrap JSON in a fenced block despite instructions
+            text = text.strip("`").removeprefix("json").strip()
+        if not text.startswith("{"):
+            return None
+        return TriageOutput.model_validate_json(text)
+    except (ValidationError, ValueError) as e:
+        logger.warning(f"Structured triage output did not match the schema: {e}")
+        return None
+
+
+def bind_triage_schema(llm):
+    """Bind the TriageOutput function to a chat model; models without tool support are returned as is."""
+    try:
+        return llm.bind_tools([TriageOutput], tool_choice=TriageOutput.__name__)
+    except (NotImplementedError, AttributeError):
+        return llm
+
+
+def parse_triage_response(response, with_summary: bool = False) -> TriageOutput:
+    """Parse an LLM triage answer: function call first, then JSON content, then free text.
+
+    with_summary extracts a "thread summary:" line from free-text answers
+    before they are scanned for the category.
+    """
+    result = None
+    for tool_call in getattr(response, "tool_calls", None) or []:
+        if tool_call.get("name") == TriageOutput.__name__:
+            result = parse_structured(tool_call.get("args") or {})
+            break
+    content = getattr(response, "content", response)
+    if not isinstance(content, str):
+        content = json.dumps(content)
+    if result is None:
+        result = parse_structured(content)
+    if result is None:
+        summary = None
+        if with_summary:
+            summary = extract_thread_summary(content)
+            content = strip_thread_summary(content)
+        result = parse_free_text(content)
+        result.thread_summary = summary
+    if result.category == "respond" and not result.draft:
+        result.draft = FALLBACK_DRAFT
+    return result
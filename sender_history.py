@@ -0,0 +1,237 @@
+from typing import Dict, Any, Optional, List
+from itertools import islice
+import fcntl
+import json
+import logging
+import os
+import random
+import threading
+
+from response_parser import SHORT_CIRCUIT_DECISIONS
+
+logger = logging.getLogger(__name__)
+
+# Order of the per-decision counters stored for each sender and domain
+DECISIONS = ("fyi", "discard", "respond")
+
+
+def sender_address(author: str) -> str:
+    """Extract the lowercase address from an author like 'Name <user@example.com>'."""
+    author = author.strip().lower()
+    if "<" in author and ">" in author:
+        author = author[author.index("<") + 1:author.index(">")]
+    return author.strip()
+
+
+def sender_domain(address: str) -> Optional[str]:
+    return address.rsplit("@", 1)[1] if "@" in address else None
+
+
+def _add_counts(target: Dict[str, List[int]], deltas: Dict[str, List[int]]) -> Dict[str, List[int]]:
+    # Updated keys are moved to the end, so dict order doubles as recency order
+    for key, delta in deltas.items():
+        counts = target.pop(key, None) or [0] * len(DECISIONS)
+        for column, value in enumerate(delta):
+            counts[column] += value
+        target[key] = counts
+    return target
+
+
+def _trim(counts: Dict[str, List[int]], max_entries: int) -> Dict[str, List[int]]:
+    """Drop the least recently updated entries beyond max_entries."""
+    for key in list(islice(counts, max(0, len(counts) - max_entries))):
+        del counts[key]
+    return counts
+
+
+class SenderHistoryIndex:
+    """Per-sender and per-domain decision counts used to skip the LLM for predictable senders.
+
+    Several worker processes can share one file: each keeps the counts it
+    added since its last save and merges them into the file under a lock,
+    then picks up the other workers' counts from the merged result. Both maps
+    keep at most max_entries recently updated keys.
+    """
+
+    def __init__(self, path: Optional[str] = None, min_count: int = 20, min_agreement: float = 0.95,
+                 use_domains: bool = True, flush_every: int = 50, enabled: bool = True,
+                 audit_rate: float = 0.05, max_entries: int = 50000):
+        self.path = path
+        self.min_count = min_count
+        self.min_agreement = min_agreement
+        self.use_domains = use_domains
+        self.flush_every = flush_every
+        self.enabled = enabled
+        self.audit_rate = audit_rate
+        self.max_entries = max_entries
+        self._random = random.Random()
+        self._flushing = False
+        self.audits = 0
+        self._senders: Dict[str, List[int]] = {}
+        self._domains: Dict[str, List[int]] = {}
+        # Counts added since the last save, merged into the file by save()
+        self._sender_deltas: Dict[str, List[int]] = {}
+        self._domain_deltas: Dict[str, List[int]] = {}
+        self._avoided_delta = 0
+        self._lock = threading.Lock()
+        self._dirty = 0
+        self.llm_calls_avoided = 0
+        if path and os.path.exists(path):
+            self.load()
+
+    @classmethod
+    def from_env(cls) -> "SenderHistoryIndex":
+        """Create an index configured from SENDER_HISTORY_* environment variables."""
+        return cls(
+            path=os.getenv("SENDER_HISTORY_PATH", "sender_history.json") or None,
+            min_count=int(os.getenv("SENDER_HISTORY_MIN_COUNT", "20")),
+            min_agreement=float(os.getenv("SENDER_HISTORY_MIN_AGREEMENT", "0.95")),
+            use_domains=os.getenv("SENDER_HISTORY_USE_DOMAINS", "true").lower() == "true",
+            flush_every=int(os.getenv("SENDER_HISTORY_FLUSH_EVERY", "50")),
+            enabled=os.getenv("SENDER_HISTORY_ENABLED", "true").lower() == "true",
+            audit_rate=float(os.getenv("SENDER_HISTORY_AUDIT_RATE", "0.05")),
+            max_entries=int(os.getenv("SENDER_HISTORY_MAX_ENTRIES", "50000")),
+        )
+
+    def _verdict(self, counts: Optional[List[int]]) -> Optional[str]:
+        if not counts:
+            return None
+        total = sum(counts)
+        top = max(range(len(DECISIONS)), key=lambda i: counts[i])
+        if total >= self.min_count and counts[top] / total >= self.min_agreement:
+            return DECISIONS[top]
+        return None
+
+    def lookup(self, author: str) -> Optional[str]:
+        """Return the consistent FYI/discard verdict for this sender or its domain, if any.
+
+        A domain verdict only covers senders whose own history all agrees with
+        it, so one automated sender cannot speak for everyone at a shared or
+        freemail domain. A sample of verdicts is audited by the LLM instead,
+        so the counts keep being revised.
+        """
+        if not self.enabled:
+            return None
+        address = sender_address(author)
+        with self._lock:
+            sender_counts = self._senders.get(address)
+            verdict = self._verdict(sender_counts)
+            if verdict is None and self.use_domains and sender_counts:
+                verdict = self._verdict(self._domains.get(sender_domain(address)))
+                if verdict and sum(sender_counts) != sender_counts[DECISIONS.index(verdict)]:
+                    verdict = None
+            if verdict not in SHORT_CIRCUIT_DECISIONS:
+                return None
+            if self._random.random() < self.audit_rate:
+                self.audits += 1
+                return None
+            self.llm_calls_avoided += 1
+            self._avoided_delta += 1
+            self._dirty += 1
+            return verdict
+
+    def record(self, author: str, decision: str) -> None:
+        """Count one observed decision for the sender and its domain."""
+        if not self.enabled or decision not in DECISIONS:
+            return
+        address = sender_address(author)
+        domain = sender_domain(address)
+        column = DECISIONS.index(decision)
+        delta = [0] * len(DECISIONS)
+        delta[column] = 1
+        with self._lock:
+            for counts, deltas, key in ((self._senders, self._sender_deltas, address),
+                                        (self._domains, self._domain_deltas, domain)):
+                if key:
+                    _add_counts(counts, {key: delta})
+                    _add_counts(deltas, {key: delta})
+                    # Trim with some slack so the cost is amortized over many records
+                    if len(counts) > self.max_entries + self.max_entries // 10:
+                        _trim(counts, self.max_entries)
+            self._dirty += 1
+            should_flush = self.path and self._dirty >= self.flush_every and not self._flushing
+            if should_flush:
+                self._flushing = True
+        if should_flush:
+            # Merging and rewriting the file is kept off the request thread
+            threading.Thread(target=self._flush, daemon=True).start()
+
+    def _flush(self) -> None:
+        try:
+            self.save()
+        finally:
+            self._flushing = False
+
+    def save(self) -> None:
+        """Merge the counts added since the last save into the file and write it atomically."""
+        if not self.path:
+            return
+        with self._lock:
+            sender_deltas, self._sender_deltas = self._sender_deltas, {}
+            domain_deltas, self._domain_deltas = self._domain_deltas, {}
+            avoided_delta, self._avoided_delta = self._avoided_delta, 0
+            self._dirty = 0
+        try:
+            # The lock file serializes read-merge-write cycles between workers
+            with open(f"{self.path}.lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                payload = self._read() or {}
+                senders = _trim(_add_counts(payload.get("senders", {}), sender_deltas), self.max_entries)
+                domains = _trim(_add_counts(payload.get("domains", {}), domain_deltas), self.max_entries)
+                llm_calls_avoided = payload.get("llm_calls_avoided", 0) + avoided_delta
+                data = json.dumps({
+                    "decisions": DECISIONS,
+                    "senders": senders,
+                    "domains": domains,
+                    "llm_calls_avoided": llm_calls_avoided,
+                }, separators=(",", ":"))
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save sender history to {self.path}: {e}")
+            with self._lock:
+                # Keep the unsaved counts for the next attempt
+                _add_counts(self._sender_deltas, sender_deltas)
+                _add_counts(self._domain_deltas, domain_deltas)
+                self._avoided_delta += avoided_delta
+            return
+        with self._lock:
+            # Adopt the merged counts, plus anything recorded while the file was written
+            self._senders = _add_counts(senders, self._sender_deltas)
+            self._domains = _add_counts(domains, self._domain_deltas)
+            self.llm_calls_avoided = llm_calls_avoided + self._avoided_delta
+
+    def _read(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path) as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load sender history from {self.path}: {e}")
+            return None
+        if tuple(payload.get("decisions", ())) != DECISIONS:
+            logger.warning(f"Ignoring sender history with unknown layout: {self.path}")
+            return None
+        return payload
+
+    def load(self) -> None:
+        payload = self._read()
+        if payload is None:
+            return
+        with self._lock:
+            self._senders = _add_counts(payload.get("senders", {}), self._sender_deltas)
+            self._domains = _add_counts(payload.get("domains", {}), self._domain_deltas)
+            self.llm_calls_avoided = payload.get("llm_calls_avoided", 0) + self._avoided_delta
+        logger.info(f"Loaded sender history for {len(self._senders)} senders from {self.path}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "senders": len(self._senders),
+            "domains": len(self._domains),
+            "llm_calls_avoided": self.llm_calls_avoided,
+            "audits": self.audits,
+        }
@@ -0,0 +1,142 @@
+from typing import Dict, Any, Optional, MutableMapping
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_SUFFIX = ".json.gz"
+
+
+class SessionSnapshot:
+    """On-disk snapshot of pending sessions, written at shutdown and restored on demand.
+
+    The snapshot path is a directory holding one gzip-compressed JSON file per
+    session, so instances sharing a mount never overwrite each other's
+    sessions. Nothing is read at startup; a session's file is claimed the
+    first time it is missing from the live stores. Claiming renames the file
+    before reading it and deletes it after the session is restored, so only
+    one instance restores it and a crash after the restore cannot bring the
+    session back a second time. Sessions older than ttl_seconds are not
+    written, and files left older than that are pruned at every save.
+    """
+
+    def __init__(self, path: Optional[str], ttl_seconds: float = 7 * 24 * 3600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self.saved = 0
+        self.restored = 0
+        self.pruned = 0
+
+    @classmethod
+    def from_env(cls) -> "SessionSnapshot":
+        return cls(
+            os.getenv("SESSION_SNAPSHOT_PATH") or None,
+            ttl_seconds=float(os.getenv("SESSION_SNAPSHOT_TTL_SECONDS", str(7 * 24 * 3600))),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _session_path(self, session_id: str) -> Optional[str]:
+        # Session IDs come from requests; never let one name a path outside the directory
+        if not session_id or session_id.startswith(".") or os.path.basename(session_id) != session_id:
+            return None
+        return os.path.join(self.path, session_id + SNAPSHOT_SUFFIX)
+
+    def save(self, pending_responses: MutableMapping[str, Dict[str, Any]], agent) -> int:
+        """Write every pending session and its checkpoint values; returns the number saved."""
+        if not self.enabled:
+            return 0
+        os.makedirs(self.path, exist_ok=True)
+        now = time.time()
+        self._prune(now)
+        saved = 0
+        for session_id in list(pending_responses):
+            session_path = self._session_path(session_id)
+            if session_path is None:
+                continue
+            try:
+                pending = pending_responses[session_id]
+                created = pending.get("created", now)
+                if self.ttl_seconds and created < now - self.ttl_seconds:
+                    continue
+                session = {
+                    "version": SNAPSHOT_VERSION,
+                    "created": created,
+                    "pending": pending,
+                    "values": agent.export_session(session_id),
+                }
+            except KeyError:
+                continue
+            tmp_path = f"{session_path}.{os.getpid()}.tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                json.dump(session, f, separators=(",", ":"), default=str)
+            os.replace(tmp_path, session_path)
+            saved += 1
+        self.saved += saved
+        logger.info(f"Saved snapshot of {saved} pending sessions to {self.path}")
+        return saved
+
+    def _prune(self, now: float) -> None:
+        """Delete snapshot, temporary and claimed files not written within the TTL."""
+        if not self.ttl_seconds:
+            return
+        for entry in os.scandir(self.path):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < now - self.ttl_seconds:
+                    os.remove(entry.path)
+                    self.pruned += 1
+            except FileNotFoundError:
+                # Claimed or pruned by another instance meanwhile
+                continue
+
+    def _claim(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Take a session's file for this process; None if it is missing or another instance got it."""
+        session_path = self._session_path(session_id)
+        if session_path is None:
+            return None
+        claimed_path = f"{session_path}.{os.getpid()}.claimed"
+        try:
+            os.rename(session_path, claimed_path)
+        except FileNotFoundError:
+            return None
+        try:
+            with gzip.open(claimed_path, "rt", encoding="utf-8") as f:
+                session = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load session snapshot for {session_id}: {e}")
+            session = None
+        os.remove(claimed_path)
+        if session is None or session.get("version") != SNAPSHOT_VERSION:
+            return None
+        return session
+
+    def restore(self, session_id: str, pending_responses: MutableMapping[str, Dict[str, Any]], agent) -> bool:
+        """Bring one session back from the snapshot into the live stores, if it is there."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            session = self._claim(session_id)
+        if session is None:
+            return False
+        if session.get("values"):
+            agent.import_session(session_id, session["values"])
+        pending_responses[session_id] = session["pending"]
+        self.restored += 1
+        logger.info(f"Restored session {session_id} from snapshot")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "saved": self.saved,
+            "restored": self.restored,
+            "pruned": self.pruned,
+        }
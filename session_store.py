@@ -0,0 +1,100 @@
+from typing import Dict, Any, Iterator, Optional
+from collections.abc import MutableMapping
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from langgraph.checkpoint.memory import MemorySaver
+
+logger = logging.getLogger(__name__)
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    """Open a SQLite connection suitable for sharing between processes."""
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+class SqliteSessionStore(MutableMapping):
+    """Dict-like store of pending sessions in a shared SQLite database (WAL mode)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS pending_responses (session_id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self._conn().commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; SQLite serializes writers across processes
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = _connect(self.path)
+        return conn
+
+    def __getitem__(self, session_id: str) -> Dict[str, Any]:
+        row = self._conn().execute(
+            "SELECT data FROM pending_responses WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(session_id)
+        return json.loads(row[0])
+
+    def __setitem__(self, session_id: str, value: Dict[str, Any]) -> None:
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO pending_responses (session_id, data) VALUES (?, ?)",
+            (session_id, json.dumps(value, separators=(",", ":"))),
+        )
+        conn.commit()
+
+    def __delitem__(self, session_id: str) -> None:
+        conn = self._conn()
+        cursor = conn.execute("DELETE FROM pending_responses WHERE session_id = ?", (session_id,))
+        conn.commit()
+        if cursor.rowcount == 0:
+            raise KeyError(session_id)
+
+    def __contains__(self, session_id: object) -> bool:
+        return self._conn().execute(
+            "SELECT 1 FROM pending_responses WHERE session_id = ?", (session_id,)
+        ).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        rows = self._conn().execute("SELECT session_id FROM pending_responses").fetchall()
+        return iter(row[0] for row in rows)
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM pending_responses").fetchone()[0]
+
+
+def session_db_path() -> Optional[str]:
+    return os.getenv("SESSION_DB_PATH") or None
+
+
+def create_session_store() -> MutableMapping:
+    """Return the pending-session store: shared SQLite when SESSION_DB_PATH is set, else a dict."""
+    path = session_db_path()
+    if path:
+        logger.info(f"Using shared SQLite session store at {path}")
+        return SqliteSessionStore(path)
+    return {}
+
+
+def create_checkpointer():
+    """Return the LangGraph checkpointer: shared SqliteSaver when SESSION_DB_PATH is set, else MemorySaver."""
+    path = session_db_path()
+    if path:
+        from langgraph.checkpoint.sqlite import SqliteSaver
+
+        logger.info(f"Using shared SQLite checkpointer at {path}")
+        saver = SqliteSaver(_connect(path))
+        saver.setup()
+        return saver
+    return MemorySaver()
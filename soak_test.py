@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Memory soak test for the Email Triage Agent
+Drives main.app in-process with a stub LLM and mixed traffic, sampling RSS and
+tracemalloc, and fails when memory grows beyond the configured thresholds
+"""
+
+from contextlib import redirect_stdout
+import argparse
+import gc
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+FIRST_NAMES = ["Alice", "Bob", "Carmen", "Dmitri", "Elena", "Farah", "Goran", "Hiro", "Ines", "Jamal"]
+DOMAINS = ["example.com", "acme.io", "contoso.org", "initech.net", "globex.co"]
+WORDS = ["project", "invoice", "meeting", "report", "budget", "release", "customer", "schedule",
+         "review", "deadline", "contract", "update", "travel", "expense", "roadmap", "hiring"]
+
+
+def rss_bytes():
+    """Current resident set size; falls back to the peak on systems without /proc."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def random_email(rng, body_lines):
+    name = rng.choice(FIRST_NAMES)
+    body = "\n".join(" ".join(rng.choice(WORDS) for _ in range(10)) for _ in range(body_lines))
+    return {
+        "author": f"{name} <{name.lower()}{rng.randrange(1000)}@{rng.choice(DOMAINS)}>",
+        "to": "user@example.com",
+        "subject": f"{rng.choice(WORDS).title()} {rng.randrange(10 ** 6)}",
+        "email_thread": f"Hi,\n\n{body}\n\nThanks,\n{name}",
+    }
+
+
+class SoakTraffic:
+    """Mix of triage, approval, rejection and abandoned sessions against a TestClient."""
+
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.counts = {"triaged": 0, "needs_response": 0, "approved": 0, "rejected": 0, "abandoned": 0, "errors": 0}
+
+    def _post(self, path, payload):
+        response = self.client.post(path, json=payload)
+        if response.status_code != 200:
+            self.counts["errors"] += 1
+            return None
+        return response.json()
+
+    def step(self):
+        """Triage one email and, if it needs a response, resolve or abandon its session."""
+        result = self._post("/triage_email", random_email(self.rng, self.args.body_lines))
+        self.counts["triaged"] += 1
+        session_id = result and result.get("session_id")
+        if not session_id:
+            return
+        self.counts["needs_response"] += 1
+        if self.rng.random() < self.args.abandon_rate:
+            self.counts["abandoned"] += 1
+            return
+        for _ in range(self.rng.randint(0, self.args.max_rejections) if self.rng.random() < self.args.reject_rate else 0):
+            self._post("/triage_email_response", {"session_id": session_id, "approve_email": False})
+            self.counts["rejected"] += 1
+        self._post("/triage_email_response", {"session_id": session_id, "approve_email": True})
+        self.counts["approved"] += 1
+
+
+def take_sample(started, traffic, pending_responses, baseline, top):
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    sample = {
+        "elapsed_seconds": round(time.monotonic() - started, 1),
+        **traffic.counts,
+        "pending_sessions": len(pending_responses),
+        "rss_mb": round(rss_bytes() / 1e6, 2),
+        "traced_mb": round(tracemalloc.get_traced_memory()[0] / 1e6, 2),
+    }
+    if baseline is not None:
+        sample["top_allocators"] = [
+            {"location": str(stat.traceback), "size_diff_kb": round(stat.size_diff / 1024, 1), "count_diff": stat.count_diff}
+            for stat in snapshot.compare_to(baseline, "lineno")[:top]
+        ]
+    return sample, snapshot
+
+
+def print_sample(sample):
+    print(f"[{sample['elapsed_seconds']:>8.1f}s] triaged {sample['triaged']:>7}  needs response {sample['needs_response']:>6}  "
+          f"pending {sample['pending_sessions']:>6}  rss {sample['rss_mb']:8.2f} MB  traced {sample['traced_mb']:8.2f} MB",
+          flush=True)
+
+
+def run(args):
+    """Run the soak test; returns the process exit code."""
+    tmp = tempfile.TemporaryDirectory()
+    # Stub LLM and no learned state on disk, unless the caller configured otherwise
+    os.environ.setdefault("LLM_BACKEND", "stub")
+    os.environ.setdefault("SENDER_HISTORY_PATH", "")
+    os.environ.setdefault("LOCAL_CLASSIFIER_MODEL_PATH", "")
+    os.environ.setdefault("LOCAL_CLASSIFIER_EXAMPLES_PATH", "")
+    os.environ.setdefault("SESSION_SNAPSHOT_PATH", os.path.join(tmp.name, "snapshot"))
+
+    tracemalloc.start(args.frames)
+    from fastapi.testclient import TestClient
+    import main
+
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+    report = open(args.report, "w") if args.report else None
+    devnull = io.StringIO()
+    started = time.monotonic()
+    deadline = started + args.duration
+    baseline = baseline_sample = None
+
+    with TestClient(main.app) as client:
+        traffic = SoakTraffic(client, args)
+        next_sample = time.monotonic()
+        while time.monotonic() < deadline and not (args.emails and traffic.counts["triaged"] >= args.emails):
+            with redirect_stdout(devnull):
+                traffic.step()
+            devnull.seek(0)
+            devnull.truncate()
+
+            if baseline is None and traffic.counts["triaged"] >= args.warmup:
+                # Imports, caches and lazily built objects settle during warm-up
+                baseline_sample, baseline = take_sample(started, traffic, main.pending_responses, None, args.top)
+                print_sample(baseline_sample)
+                next_sample = time.monotonic() + args.sample_interval
+            elif baseline is not None and time.monotonic() >= next_sample:
+                sample, _ = take_sample(started, traffic, main.pending_responses, baseline, args.top)
+                print_sample(sample)
+                if report:
+                    report.write(json.dumps(sample) + "\n")
+                    report.flush()
+                next_sample = time.monotonic() + args.sample_interval
+
+            if args.rate:
+                time.sleep(1.0 / args.rate)
+
+        if baseline is None:
+            print(f"Only {traffic.counts['triaged']} emails triaged; increase --duration or lower --warmup")
+            return 2
+        final, _ = take_sample(started, traffic, main.pending_responses, baseline, args.top)
+
+    if report:
+        report.write(json.dumps(final) + "\n")
+        report.close()
+    tmp.cleanup()
+
+    # Every triaged email gets its own session ID and checkpoint thread
+    sessions = max(final["triaged"] - baseline_sample["triaged"], 1)
+    rss_growth = final["rss_mb"] - baseline_sample["rss_mb"]
+    traced_growth = (final["traced_mb"] - baseline_sample["traced_mb"]) * 1e6
+    per_session = traced_growth / sessions
+
+    print("\n" + "=" * 60)
+    print_sample(final)
+    print(f"Counts: {json.dumps(traffic.counts)}")
+    print(f"RSS growth since warm-up: {rss_growth:.2f} MB (limit {args.max_growth_mb} MB)")
+    print(f"Traced growth per session: {per_session:,.0f} bytes over {sessions} sessions "
+          f"(limit {args.max_bytes_per_session:,} bytes)")
+    print(f"\nTop {args.top} allocators since warm-up:")
+    for stat in final["top_allocators"]:
+        print(f"  {stat['size_diff_kb']:>10.1f} KB  {stat['count_diff']:>8} blocks  {stat['location']}")
+
+    failures = []
+    if rss_growth > args.max_growth_mb:
+        failures.append(f"RSS grew {rss_growth:.2f} MB > {args.max_growth_mb} MB")
+    if per_session > args.max_bytes_per_session:
+        failures.append(f"{per_session:,.0f} bytes per session > {args.max_bytes_per_session:,}")
+    if failures:
+        print("\nFAIL: " + "; ".join(failures))
+        return 1
+    print("\nPASS")
+    return 0
+
+
+def main():
+    """Parse arguments and run the soak test."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--duration", type=float, default=3600, help="Seconds of simulated traffic")
+    parser.add_argument("--emails", type=int, default=0, help="Stop after this many triaged emails (0 = no limit)")
+    parser.add_argument("--warmup", type=int, default=200, help="Emails triaged before the baseline is taken")
+    parser.add_argument("--sample-interval", type=float, default=60, help="Seconds between memory samples")
+    parser.add_argument("--rate", type=float, default=0, help="Emails per second (0 = as fast as possible)")
+    parser.add_argument("--abandon-rate", type=float, default=0.2, help="Share of sessions never approved")
+    parser.add_argument("--reject-rate", type=float, default=0.3, help="Share of sessions rejected before approval")
+    parser.add_argument("--max-rejections", type=int, default=3)
+    parser.add_argument("--body-lines", type=int, default=20)
+    parser.add_argument("--max-growth-mb", type=float, default=100, help="Fail when RSS grows more than this")
+    parser.add_argument("--max-bytes-per-session", type=int, default=20000,
+                        help="Fail when traced memory grows more than this per session")
+    parser.add_argument("--top", type=int, default=10, help="Allocators listed per sample")
+    parser.add_argument("--frames", type=int, default=1, help="Traceback depth recorded by tracemalloc")
+    parser.add_argument("--report", help="Write samples as JSONL to this file")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,14 @@ Test script for the Email Triage Agent
 import requests
 import json
 import time
+import base64
+import uuid
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
 
 # API base URL
 BASE_URL = "http://localhost:8000"
@@ -159,6 +167,210 @@ def test_fyi_email():
     except Exception as e:
         print(f"FYI email test failed: {e}")
 
+def pubsub_envelope(message_id, payload):
+    """Wrap a payload the way a Pub/Sub push subscription delivers it."""
+    return {
+        "message": {
+            "data": base64.b64encode(payload).decode(),
+            "messageId": message_id,
+            "attributes": {}
+        },
+        "subscription": "projects/test/subscriptions/email-triage-push"
+    }
+
+def test_pubsub_push():
+    """Act as a fake Pub/Sub push sender, including a redelivered message, against a local stub server."""
+    print("\nTesting Pub/Sub push ingestion...")
+    
+    port = free_port()
+    local_url = f"http://127.0.0.1:{port}"
+    env = {
+        "NEAR_DUPLICATE_ENABLED": "false",
+        "SENDER_HISTORY_ENABLED": "false",
+        "LOCAL_CLASSIFIER_ENABLED": "false"
+    }
+    message_id = str(uuid.uuid4())
+    email_data = {
+        "author": "alerts@monitoring.example.com",
+        "to": "user@company.com",
+        "subject": "Nightly backup completed",
+        "email_thread": "The nightly backup completed successfully. No action is required."
+    }
+    raw_email = (
+        b"From: colleague@company.com\r\nTo: user@company.com\r\n"
+        b"Subject: Lunch on Friday?\r\nMessage-ID: <lunch@company.com>\r\n\r\n"
+        b"Are you free for lunch on Friday?\r\n"
+    )
+    
+    envelopes = [
+        pubsub_envelope(message_id, json.dumps(email_data).encode()),
+        pubsub_envelope(message_id, json.dumps(email_data).encode()),  # redelivery
+        pubsub_envelope(str(uuid.uuid4()), raw_email),
+    ]
+    
+    server = start_local_server(port, env)
+    try:
+        # Each push is acknowledged only after its micro-batch was triaged
+        for envelope in envelopes:
+            response = requests.post(f"{local_url}/pubsub/push", json=envelope)
+            print(f"Push response status: {response.status_code}")
+            assert response.status_code == 204, f"push was not acknowledged: {response.status_code}"
+        stats = requests.get(f"{local_url}/health").json().get("push", {})
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    
+    print(f"Push stats: {json.dumps(stats, indent=2)}")
+    duplicates = stats.get('duplicates', 0)
+    processed = stats.get('processed', 0)
+    print(f"Duplicates dropped: {duplicates}, emails triaged: {processed}")
+    assert duplicates == 1, f"expected 1 duplicate, got {duplicates}"
+    assert processed == 2, f"expected 2 triaged emails, got {processed}"
+    print("Pub/Sub push test passed")
+
+def free_port():
+    """Return a TCP port that is free on localhost."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_local_server(port, env):
+    """Start main.py with a stub LLM on the given port and wait until it is healthy."""
+    server = subprocess.Popen(
+        [sys.executable, "main.py"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, **env, "PORT": str(port), "LLM_BACKEND": "stub"}
+    )
+    for _ in range(120):
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return server
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+def test_shutdown_restore():
+    """SIGTERM a server with a pending session, restart it, then reject and approve that session."""
+    print("\nTesting SIGTERM -> restart -> approve round trip...")
+    
+    port = free_port()
+    local_url = f"http://127.0.0.1:{port}"
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            "SESSION_SNAPSHOT_PATH": os.path.join(tmp, "sessions"),
+            "NEAR_DUPLICATE_ENABLED": "false",
+            "SENDER_HISTORY_ENABLED": "false",
+            "LOCAL_CLASSIFIER_ENABLED": "false"
+        }
+        email_data = {
+            "author": "colleague@company.com",
+            "to": "user@company.com",
+            "subject": "Can we meet tomorrow?",
+            "email_thread": "Hi, do you have 30 minutes tomorrow to go over the launch plan?"
+        }
+        
+        server = start_local_server(port, env)
+        try:
+            # The stub LLM cycles through FYI, respond and discard answers
+            session_id = None
+            for _ in range(3):
+                result = requests.post(f"{local_url}/triage_email", json=email_data).json()
+                session_id = result.get("session_id")
+                if session_id:
+                    break
+            print(f"Pending session: {session_id}")
+            server.send_signal(signal.SIGTERM)
+            print(f"Server exited with code {server.wait(timeout=30)}")
+        finally:
+            if server.poll() is None:
+                server.kill()
+        
+        session_file = os.path.join(env["SESSION_SNAPSHOT_PATH"], f"{session_id}.json.gz")
+        print(f"Snapshot written: {os.path.exists(session_file)}")
+        
+        server = start_local_server(port, env)
+        try:
+            rejection = requests.post(f"{local_url}/triage_email_response",
+                                      json={"session_id": session_id, "approve_email": False})
+            print(f"Rejection after restart: {rejection.status_code} {rejection.json()}")
+            approval = requests.post(f"{local_url}/triage_email_response",
+                                     json={"session_id": session_id, "approve_email": True})
+            print(f"Approval after restart: {approval.status_code} {approval.json()}")
+            # The restored session is claimed, so a crash now could not restore it a second time
+            print(f"Snapshot file left after restore: {os.path.exists(session_file)}")
+            assert rejection.status_code == 200, f"rejection after restart failed: {rejection.status_code}"
+            assert approval.json().get("triage_decision") == "approved", "approval after restart failed"
+            assert not os.path.exists(session_file), "restored session is still in the snapshot"
+            print("Round trip passed")
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+def test_prompt_prefix():
+    """Check that every LLM call of a kind starts with a byte-identical static prefix."""
+    print("\nTesting prompt prefix stability...")
+    # The agent reads these when it is built; restore them so later tests see the real settings
+    overrides = {
+        "LLM_BACKEND": "stub",
+        "SENDER_HISTORY_ENABLED": "false",
+        "NEAR_DUPLICATE_ENABLED": "false",
+        "LOCAL_CLASSIFIER_ENABLED": "false"
+    }
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        from email_agent_correct import EmailTriageAgent
+    
+        class RecordingLLM:
+            """Wraps the stub LLM and keeps the messages of every call."""
+            def __init__(self, llm):
+                self.llm = llm
+                self.calls = []
+        
+            def invoke(self, messages):
+                self.calls.append(messages)
+                return self.llm.invoke(messages)
+    
+        agent = EmailTriageAgent()
+        agent.llm = RecordingLLM(agent.llm)
+        emails = [
+            ("alice@example.com", "Lunch?", "Are you free for lunch on Friday?", None),
+            ("bob@vendor.io", "Invoice 4411", "Please find attached invoice 4411 for March.", None),
+            ("carol@partner.org", "Launch plan", "Can you review the launch plan by Monday?", "launch-thread"),
+            ("carol@partner.org", "Re: Launch plan", "Can you review the launch plan by Monday?\n\nAlso the budget.",
+             "launch-thread"),
+        ]
+        for i, (author, subject, body, thread_key) in enumerate(emails):
+            result = agent.process_email(author, "user@company.com", subject, body, f"prefix-{i}", thread_key=thread_key)
+            if result.get("needs_response"):
+                agent.reject_response(f"prefix-{i}")
+    
+        # Triage and draft prompts have two messages: the static prefix and the per-email content
+        prefixes = {}
+        for messages in agent.llm.calls:
+            kind = "draft" if "write replies" in messages[0].content else "triage"
+            prefixes.setdefault(kind, set()).add(messages[0].content.encode("utf-8"))
+        contents = [messages[-1].content for messages in agent.llm.calls]
+    
+        print(f"LLM calls: {len(agent.llm.calls)}, distinct prefixes: "
+              f"{ {kind: len(variants) for kind, variants in prefixes.items()} }")
+        assert all(len(messages) == 2 for messages in agent.llm.calls), "a call did not send prefix + content"
+        assert set(prefixes) == {"triage", "draft"}, f"unexpected call kinds: {set(prefixes)}"
+        assert all(len(variants) == 1 for variants in prefixes.values()), "a prefix varied between calls"
+        assert not any(author in prefix.decode() for author, *_ in emails for variants in prefixes.values()
+                       for prefix in variants), "per-email data leaked into a prefix"
+        assert len(set(contents)) == len(contents), "per-email content repeated between calls"
+        print("Prefix check passed")
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
 def main():
     """Run all tests."""
     print("Starting Email Triage Agent Tests")
@@ -172,6 +384,12 @@ def main():
     # Test FYI email (should not need response)
     test_fyi_email()
     
+    # Test Pub/Sub push ingestion with a redelivered message
+    try:
+        test_pubsub_push()
+    except Exception as e:
+        print(f"Pub/Sub push test failed: {e}")
+    
     # Test email that needs response
     session_id = test_email_triage()
     
@@ -189,5 +407,23 @@ def main():
     else:
         print("\nNo response needed for the test email.")
 
+def run_check(test):
+    """Run an assert-based test from the command line and return its exit code."""
+    try:
+        test()
+    except AssertionError as e:
+        print(f"FAILED: {e}")
+        return 1
+    return 0
+
 if __name__ == "__main__":
+    if "--prompt-prefix" in sys.argv:
+        # Offline: runs the agent in-process with a stub LLM
+        sys.exit(run_check(test_prompt_prefix))
+    if "--pubsub-push" in sys.argv:
+        # Self-contained: starts and stops its own local server
+        sys.exit(run_check(test_pubsub_push))
+    if "--shutdown-restore" in sys.argv:
+        # Self-contained: starts and stops its own local servers
+        sys.exit(run_check(test_shutdown_restore))
     main()
@@ -0,0 +1,57 @@
+from typing import Optional
+import hashlib
+import os
+import re
+
+# Checkpointer thread IDs for per-thread context, kept apart from session IDs
+THREAD_CONTEXT_PREFIX = "thread:"
+THREAD_SUMMARY_MAX_CHARS = int(os.getenv("THREAD_SUMMARY_MAX_CHARS", "2000"))
+
+THREAD_SUMMARY_RE = re.compile(r"^[ \t]*thread summary:[ \t]*(.*)$\n?", re.IGNORECASE | re.MULTILINE)
+MESSAGE_ID_RE = re.compile(r"<[^<>\s]+>")
+
+
+def derive_thread_key(message_id: Optional[str] = None, in_reply_to: Optional[str] = None,
+                      references: Optional[str] = None) -> Optional[str]:
+    """Key a thread by its root Message-ID: first References entry, else In-Reply-To, else the message itself."""
+    for header in (references, in_reply_to, message_id):
+        if header:
+            ids = MESSAGE_ID_RE.findall(header)
+            key = ids[0] if ids else header.split()[0]
+            return key.strip("<>")
+    return None
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8", errors="replace")).hexdigest()
+
+
+def new_message_delta(email_thread: str, seen_length: int, seen_hash: Optional[str]) -> str:
+    """Return the part of email_thread not seen in the previous triage of this thread.
+
+    Handles callers that append new messages to the thread as well as replies
+    that put the new message on top of the quoted history; otherwise the whole
+    text is treated as new.
+    """
+    if seen_hash and 0 < seen_length <= len(email_thread):
+        if text_hash(email_thread[:seen_length]) == seen_hash:
+            return email_thread[seen_length:].strip()
+        if text_hash(email_thread[-seen_length:]) == seen_hash:
+            return email_thread[:-seen_length].strip()
+    return email_thread
+
+
+def extract_thread_summary(content: str) -> Optional[str]:
+    match = THREAD_SUMMARY_RE.search(content)
+    return match.group(1).strip() if match and match.group(1).strip() else None
+
+
+def strip_thread_summary(content: str) -> str:
+    return THREAD_SUMMARY_RE.sub("", content, count=1)
+
+
+def rolling_summary(previous_summary: Optional[str], new_message: str,
+                    max_chars: int = THREAD_SUMMARY_MAX_CHARS) -> str:
+    """Fallback summary when the LLM did not provide one: previous summary plus the new message, tail-truncated."""
+    combined = f"{previous_summary}\n{new_message}" if previous_summary else new_message
+    return combined.strip()[-max_chars:]
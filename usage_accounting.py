@@ -0,0 +1,163 @@
+from typing import Dict, Any, Optional, Tuple
+from collections import defaultdict, deque
+from email.utils import getaddresses
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+from sender_history import sender_address, sender_domain
+
+logger = logging.getLogger(__name__)
+
+# USD per 1K prompt/completion tokens; override with LLM_PRICING_JSON
+DEFAULT_PRICING = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+
+def extract_usage(response) -> Tuple[int, int, int]:
+    """Return (prompt, completion, cached prompt) tokens reported with an LLM response."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        details = usage.get("input_token_details") or {}
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0), details.get("cache_read", 0) or 0
+    token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    details = token_usage.get("prompt_tokens_details") or {}
+    return (
+        token_usage.get("prompt_tokens", 0),
+        token_usage.get("completion_tokens", 0),
+        details.get("cached_tokens", 0) or 0,
+    )
+
+
+def model_name(llm) -> str:
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+
+
+def recipient_tenant(to: str) -> Optional[str]:
+    """Tenant of an email: the domain of the first address in its To header."""
+    addresses = [address for _, address in getaddresses([to or ""]) if address]
+    return sender_domain(addresses[0].strip().lower()) if addresses else None
+
+
+def empty_session_usage() -> Dict[str, Any]:
+    return {"nodes": {}, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+            "cost_usd": 0.0, "regenerations": 0, "degraded_calls": 0}
+
+
+class UsageLedger:
+    """Token and cost accounting per session, node and sender domain, with budget checks."""
+
+    def __init__(self, pricing: Optional[Dict[str, Tuple[float, float]]] = None,
+                 max_regenerations: int = 0, tenant_tokens_per_minute: int = 0):
+        self.pricing = pricing or DEFAULT_PRICING
+        self.max_regenerations = max_regenerations
+        self.tenant_tokens_per_minute = tenant_tokens_per_minute
+        self._lock = threading.Lock()
+        self._by_domain: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self._by_node: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self._tenant_windows: Dict[str, deque] = defaultdict(deque)
+        self.degraded_calls = 0
+
+    @classmethod
+    def from_env(cls) -> "UsageLedger":
+        """Create a ledger configured from LLM_PRICING_JSON and budget environment variables."""
+        pricing = dict(DEFAULT_PRICING)
+        if os.getenv("LLM_PRICING_JSON"):
+            pricing.update({model: tuple(prices) for model, prices in json.loads(os.environ["LLM_PRICING_JSON"]).items()})
+        return cls(
+            pricing=pricing,
+            max_regenerations=int(os.getenv("MAX_REGENERATIONS_PER_SESSION", "0")),
+            tenant_tokens_per_minute=int(os.getenv("TENANT_TOKENS_PER_MINUTE", "0")),
+        )
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        prompt_price, completion_price = self.pricing.get(model, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+    def _tenant_tokens(self, tenant: str, now: float) -> int:
+        window = self._tenant_windows.get(tenant)
+        if window is None:
+            return 0
+        while window and window[0][0] < now - 60:
+            window.popleft()
+        if not window:
+            # Idle tenants do not keep an entry
+            del self._tenant_windows[tenant]
+            return 0
+        return sum(tokens for _, tokens in window)
+
+    def allow_full_model(self, tenant: Optional[str], session_usage: Optional[Dict[str, Any]] = None,
+                         regeneration: bool = False) -> bool:
+        """Return False when a budget is exhausted and the cheaper path should be used."""
+        if regeneration and self.max_regenerations and session_usage \
+                and session_usage.get("regenerations", 0) >= self.max_regenerations:
+            return False
+        if self.tenant_tokens_per_minute and tenant:
+            with self._lock:
+                if self._tenant_tokens(tenant, time.monotonic()) >= self.tenant_tokens_per_minute:
+                    return False
+        return True
+
+    def record(self, session_usage: Optional[Dict[str, Any]], node: str, model: str, response,
+               author: str, tenant: Optional[str], degraded: bool = False) -> Dict[str, Any]:
+        """Add one LLM call to the session's usage and the aggregates; returns the updated session usage."""
+        prompt_tokens, completion_tokens, cached_tokens = extract_usage(response)
+        cost = self.cost(model, prompt_tokens, completion_tokens)
+        logger.info(f"{node} used {prompt_tokens} prompt tokens ({cached_tokens} cached) "
+                    f"and {completion_tokens} completion tokens on {model}")
+
+        usage = copy.deepcopy(session_usage) if session_usage else empty_session_usage()
+        node_usage = usage["nodes"].setdefault(node, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                                       "cached_tokens": 0, "cost_usd": 0.0})
+        for target in (usage, node_usage):
+            target["prompt_tokens"] += prompt_tokens
+            target["completion_tokens"] += completion_tokens
+            target["cached_tokens"] += cached_tokens
+            target["cost_usd"] = round(target["cost_usd"] + cost, 6)
+        node_usage["calls"] += 1
+        if degraded:
+            usage["degraded_calls"] += 1
+
+        domain = sender_domain(sender_address(author)) or "unknown"
+        with self._lock:
+            for aggregate in (self._by_domain[domain], self._by_node[node]):
+                aggregate["calls"] += 1
+                aggregate["prompt_tokens"] += prompt_tokens
+                aggregate["completion_tokens"] += completion_tokens
+                aggregate["cached_tokens"] += cached_tokens
+                aggregate["cost_usd"] += cost
+            if self.tenant_tokens_per_minute and tenant:
+                now = time.monotonic()
+                self._tenant_tokens(tenant, now)
+                self._tenant_windows[tenant].append((now, prompt_tokens + completion_tokens))
+            if degraded:
+                self.degraded_calls += 1
+        return usage
+
+    @staticmethod
+    def _rounded(aggregate: Dict[str, float]) -> Dict[str, Any]:
+        rounded = {key: round(value, 6) if key == "cost_usd" else int(value) for key, value in aggregate.items()}
+        # Share of prompt tokens served from the provider's prompt cache
+        rounded["cache_hit_ratio"] = round(aggregate["cached_tokens"] / aggregate["prompt_tokens"], 4) \
+            if aggregate["prompt_tokens"] else 0.0
+        return rounded
+
+    def report(self, top: int = 20) -> Dict[str, Any]:
+        """Aggregates by node and the sender domains with the highest cost."""
+        with self._lock:
+            by_domain = sorted(self._by_domain.items(), key=lambda item: item[1]["cost_usd"], reverse=True)
+            return {
+                "by_node": {node: self._rounded(values) for node, values in self._by_node.items()},
+                "by_sender_domain": {domain: self._rounded(values) for domain, values in by_domain[:top]},
+                "degraded_calls": self.degraded_calls,
+                "budgets": {
+                    "max_regenerations_per_session": self.max_regenerations,
+                    "tenant_tokens_per_minute": self.tenant_tokens_per_minute,
+                },
+            }